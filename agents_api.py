@@ -1,8 +1,111 @@
 from config import *
+from requests.adapters import HTTPAdapter
+import threading
 import requests
+import metrics
+import time
+
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=AGENTS_API_POOL_SIZE))
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=AGENTS_API_POOL_SIZE))
+
+def record_call(endpoint, duration, error=False):
+    metrics.observe('agents_api_call_seconds', duration, {"endpoint": endpoint})
+    metrics.increment('agents_api_calls_total', {"endpoint": endpoint})
+    if error:
+        metrics.increment('agents_api_errors_total', {"endpoint": endpoint})
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails calls to MAIN_HOST fast after threshold consecutive failures (connection errors and 5xx).
+
+    After reset_timeout one probe call is let through: success closes the circuit, failure keeps it open for another
+    reset_timeout. Shared by the sync and the async client.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                print('{}: circuit to {} closed'.format(time.strftime("%Y-%m-%d %H:%M:%S"), MAIN_HOST))
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                if not self.probing:
+                    print('{}: circuit to {} opened after {} failures'.format(time.strftime("%Y-%m-%d %H:%M:%S"),
+                                                                             MAIN_HOST, self.failures))
+                self.opened_at = time.time()
+                self.probing = False
+
+    def abandon(self):
+        # a call that was cancelled says nothing about MAIN_HOST; if it was the probe, the next call probes again
+        with self.lock:
+            self.probing = False
+
+
+breaker = CircuitBreaker(AGENTS_API_BREAKER_THRESHOLD, AGENTS_API_BREAKER_RESET)
+
+
+def before_call(endpoint):
+    if not breaker.allow():
+        metrics.increment('agents_api_rejected_total', {"endpoint": endpoint})
+        raise CircuitOpenError('circuit to {} is open'.format(MAIN_HOST))
+
+
+def after_call(endpoint, started, status=None, error=False):
+    # status is None when the request itself failed
+    error = error or status is None or status >= 400
+    record_call(endpoint, time.time() - started, error=error)
+    if status is None or status >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
 
 
-def send_message(contract_id, text, action_link=None, action_name=None, action_onetime=True, only_doctor=False,
+def post(endpoint, data):
+    before_call(endpoint)
+    started = time.time()
+    try:
+        response = session.post(MAIN_HOST + endpoint, json=data,
+                                timeout=(AGENTS_API_CONNECT_TIMEOUT, AGENTS_API_READ_TIMEOUT))
+    except Exception:
+        after_call(endpoint, started)
+        raise
+    except BaseException:
+        breaker.abandon()
+        raise
+
+    after_call(endpoint, started, response.status_code)
+    return response
+
+
+def message_data(contract_id, text, action_link=None, action_name=None, action_onetime=True, only_doctor=False,
                  only_patient=False, action_deadline=None, is_urgent=False, need_answer=False,
                  attachments=None):
     message = {
@@ -43,46 +146,14 @@ def send_message(contract_id, text, action_link=None, action_name=None, action_o
                 "base64": attachment[2],
             })
 
-    data = {
+    return {
         "contract_id": contract_id,
         "api_key": APP_KEY,
         "message": message
     }
 
-    try:
-        requests.post(MAIN_HOST + '/api/agents/message', json=data)
-    except Exception as e:
-        print('connection error', e)
-
 
-def get_categories():
-    data = {
-        "api_key": APP_KEY,
-    }
-
-    try:
-        result = requests.post(MAIN_HOST + '/api/agents/records/categories', json=data)
-        return result.json()
-    except Exception as e:
-        print('connection error', e)
-        return {}
-
-
-def get_available_categories(contract_id):
-    data = {
-        "contract_id": contract_id,
-        "api_key": APP_KEY,
-    }
-
-    try:
-        result = requests.post(MAIN_HOST + '/api/agents/records/available_categories', json=data)
-        return result.json()
-    except Exception as e:
-        print('connection error', e)
-        return {}
-
-
-def get_records(contract_id, category_name, time_from=None, time_to=None, limit=None, offset=None):
+def records_data(contract_id, category_name, time_from=None, time_to=None, limit=None, offset=None):
     data = {
         "contract_id": contract_id,
         "api_key": APP_KEY,
@@ -98,15 +169,10 @@ def get_records(contract_id, category_name, time_from=None, time_to=None, limit=
     if time_to:
         data['to'] = time_to
 
-    try:
-        result = requests.post(MAIN_HOST + '/api/agents/records/get', json=data)
-        return result.json()
-    except Exception as e:
-        print('connection error', e)
-        return {}
+    return data
 
 
-def add_record(contract_id, category_name, value, record_time=None):
+def record_data(contract_id, category_name, value, record_time=None):
     data = {
         "contract_id": contract_id,
         "api_key": APP_KEY,
@@ -117,13 +183,10 @@ def add_record(contract_id, category_name, value, record_time=None):
     if record_time:
         data['time'] = record_time
 
-    try:
-        requests.post(MAIN_HOST + '/api/agents/records/add', json=data)
-    except Exception as e:
-        print('connection error', e)
+    return data
 
 
-def add_records(contract_id, values, record_time=None):
+def add_records_data(contract_id, values, record_time=None):
     data = {
         "contract_id": contract_id,
         "api_key": APP_KEY,
@@ -134,14 +197,11 @@ def add_records(contract_id, values, record_time=None):
                           (category_name, value) in values]
     else:
         data['values'] = [{"category_name": category_name, "value": value} for (category_name, value) in values]
-    print(data)
-    try:
-        requests.post(MAIN_HOST + '/api/agents/records/add', json=data)
-    except Exception as e:
-        print('connection error', e)
 
+    return data
 
-def add_task(contract_id, text, number=1, date=None, important=False, action_link=None):
+
+def task_data(contract_id, text, number=1, date=None, important=False, action_link=None):
     data = {
         "contract_id": contract_id,
         "api_key": APP_KEY,
@@ -156,15 +216,10 @@ def add_task(contract_id, text, number=1, date=None, important=False, action_lin
     if action_link:
         data['action_link'] = action_link
 
-    try:
-        response = requests.post(MAIN_HOST + '/api/agents/tasks/add', json=data)
-        print(response)
-        answer = response.json()
-        return answer['task_id']
-    except Exception as e:
-        print('connection error', e)
+    return data
 
-def send_order(contract_id, order, receiver_id=None, params=None):
+
+def order_data(contract_id, order, receiver_id=None, params=None):
     data = {
         "contract_id": contract_id,
         "api_key": APP_KEY,
@@ -177,41 +232,139 @@ def send_order(contract_id, order, receiver_id=None, params=None):
     if params:
         data['params'] = params
 
+    return data
+
+
+def task_action_data(contract_id, task_id):
+    return {
+        "contract_id": contract_id,
+        "api_key": APP_KEY,
+        "task_id": task_id,
+    }
+
+
+def order_result(answer):
+    return int(answer['delivered']) / int(answer['receivers'])
+
+
+def send_message(contract_id, text, action_link=None, action_name=None, action_onetime=True, only_doctor=False,
+                 only_patient=False, action_deadline=None, is_urgent=False, need_answer=False,
+                 attachments=None):
+    data = message_data(contract_id, text, action_link, action_name, action_onetime, only_doctor, only_patient,
+                        action_deadline, is_urgent, need_answer, attachments)
+
     try:
-        print(data)
-        response = requests.post(MAIN_HOST + '/api/agents/order', json=data)
-        print(response)
-        answer = response.json()
-        return int(answer['delivered']) / int(answer['receivers'])
+        post('/api/agents/message', data)
     except Exception as e:
         print('connection error', e)
-        return 0
 
 
+def deliver_message(contract_id, text, **params):
+    # unlike send_message, raises on failure so the caller can retry
+    post('/api/agents/message', message_data(contract_id, text, **params)).raise_for_status()
 
-def make_task(contract_id, task_id):
+
+def get_categories():
     data = {
-        "contract_id": contract_id,
         "api_key": APP_KEY,
-        "task_id": task_id,
     }
 
     try:
-        answer = requests.post(MAIN_HOST + '/api/agents/tasks/done', json=data).json()
-        return answer['is_done']
-
+        result = post('/api/agents/records/categories', data)
+        return result.json()
     except Exception as e:
         print('connection error', e)
+        return {}
 
 
-def delete_task(contract_id, task_id):
+def get_available_categories(contract_id):
     data = {
         "contract_id": contract_id,
         "api_key": APP_KEY,
-        "task_id": task_id,
     }
 
     try:
-        requests.post(MAIN_HOST + '/api/agents/tasks/delete', json=data)
+        result = post('/api/agents/records/available_categories', data)
+        return result.json()
+    except Exception as e:
+        print('connection error', e)
+        return {}
+
+
+def get_records(contract_id, category_name, time_from=None, time_to=None, limit=None, offset=None):
+    data = records_data(contract_id, category_name, time_from, time_to, limit, offset)
+
+    try:
+        result = post('/api/agents/records/get', data)
+        return result.json()
+    except Exception as e:
+        print('connection error', e)
+        return {}
+
+
+def add_record(contract_id, category_name, value, record_time=None):
+    data = record_data(contract_id, category_name, value, record_time)
+
+    try:
+        post('/api/agents/records/add', data)
+    except Exception as e:
+        print('connection error', e)
+
+
+def add_records(contract_id, values, record_time=None):
+    data = add_records_data(contract_id, values, record_time)
+    print(data)
+    try:
+        post('/api/agents/records/add', data)
+    except Exception as e:
+        print('connection error', e)
+
+
+def upload_records(contract_id, values, record_time=None):
+    # unlike add_records, raises on failure so the caller can retry
+    post('/api/agents/records/add', add_records_data(contract_id, values, record_time)).raise_for_status()
+
+
+def add_task(contract_id, text, number=1, date=None, important=False, action_link=None):
+    data = task_data(contract_id, text, number, date, important, action_link)
+
+    try:
+        response = post('/api/agents/tasks/add', data)
+        print(response)
+        answer = response.json()
+        return answer['task_id']
+    except Exception as e:
+        print('connection error', e)
+
+def send_order(contract_id, order, receiver_id=None, params=None):
+    data = order_data(contract_id, order, receiver_id, params)
+
+    try:
+        print(data)
+        response = post('/api/agents/order', data)
+        print(response)
+        return order_result(response.json())
+    except Exception as e:
+        print('connection error', e)
+        return 0
+
+
+
+def make_task(contract_id, task_id):
+    data = task_action_data(contract_id, task_id)
+
+    try:
+        answer = post('/api/agents/tasks/done', data).json()
+        return answer['is_done']
+
+    except Exception as e:
+        print('connection error', e)
+
+
+def delete_task(contract_id, task_id):
+    data = task_action_data(contract_id, task_id)
+
+    try:
+        post('/api/agents/tasks/delete', data)
     except Exception as e:
         print('connection error', e)
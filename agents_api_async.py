@@ -0,0 +1,164 @@
+from config import *
+from agents_api import message_data, records_data, record_data, add_records_data, task_data, order_data, \
+    task_action_data, order_result, before_call, after_call, breaker
+from contextlib import asynccontextmanager
+import contextvars
+import aiohttp
+import json
+import time
+
+# every tick runs on an event loop of its own (the order scheduler and the measurement job can tick at the same
+# time), so each one opens its session with session_scope() and the calls find it through the context
+current_session = contextvars.ContextVar('agents_api_session', default=None)
+
+
+def get_session():
+    session = current_session.get()
+    if session is None:
+        raise RuntimeError('agents_api_async is used outside of session_scope()')
+    return session
+
+
+@asynccontextmanager
+async def session_scope():
+    # connect also bounds the wait for a free connection of the pool
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=AGENTS_API_ASYNC_POOL_SIZE),
+                                    timeout=aiohttp.ClientTimeout(connect=AGENTS_API_READ_TIMEOUT,
+                                                                  sock_connect=AGENTS_API_CONNECT_TIMEOUT,
+                                                                  sock_read=AGENTS_API_READ_TIMEOUT))
+    token = current_session.set(session)
+    try:
+        yield session
+    finally:
+        current_session.reset(token)
+        await session.close()
+
+
+async def post(endpoint, data):
+    before_call(endpoint)
+    started = time.time()
+    try:
+        async with get_session().post(MAIN_HOST + endpoint, json=data) as response:
+            status = response.status
+            body = await response.read()
+    except Exception:
+        after_call(endpoint, started)
+        raise
+    except BaseException:
+        # cancellation, which must not leave a probe unresolved
+        breaker.abandon()
+        raise
+
+    # a body that is not JSON is an error of this call, not a sign that MAIN_HOST is down
+    try:
+        answer = json.loads(body) if body.strip() else None
+    except ValueError:
+        after_call(endpoint, started, status, error=True)
+        raise
+
+    after_call(endpoint, started, status)
+    return answer
+
+
+async def send_message(contract_id, text, action_link=None, action_name=None, action_onetime=True, only_doctor=False,
+                       only_patient=False, action_deadline=None, is_urgent=False, need_answer=False,
+                       attachments=None):
+    data = message_data(contract_id, text, action_link, action_name, action_onetime, only_doctor, only_patient,
+                        action_deadline, is_urgent, need_answer, attachments)
+
+    try:
+        await post('/api/agents/message', data)
+    except Exception as e:
+        print('connection error', e)
+
+
+async def get_categories():
+    data = {
+        "api_key": APP_KEY,
+    }
+
+    try:
+        return await post('/api/agents/records/categories', data)
+    except Exception as e:
+        print('connection error', e)
+        return {}
+
+
+async def get_available_categories(contract_id):
+    data = {
+        "contract_id": contract_id,
+        "api_key": APP_KEY,
+    }
+
+    try:
+        return await post('/api/agents/records/available_categories', data)
+    except Exception as e:
+        print('connection error', e)
+        return {}
+
+
+async def get_records(contract_id, category_name, time_from=None, time_to=None, limit=None, offset=None):
+    data = records_data(contract_id, category_name, time_from, time_to, limit, offset)
+
+    try:
+        return await post('/api/agents/records/get', data)
+    except Exception as e:
+        print('connection error', e)
+        return {}
+
+
+async def add_record(contract_id, category_name, value, record_time=None):
+    data = record_data(contract_id, category_name, value, record_time)
+
+    try:
+        await post('/api/agents/records/add', data)
+    except Exception as e:
+        print('connection error', e)
+
+
+async def add_records(contract_id, values, record_time=None):
+    data = add_records_data(contract_id, values, record_time)
+
+    try:
+        await post('/api/agents/records/add', data)
+    except Exception as e:
+        print('connection error', e)
+
+
+async def add_task(contract_id, text, number=1, date=None, important=False, action_link=None):
+    data = task_data(contract_id, text, number, date, important, action_link)
+
+    try:
+        answer = await post('/api/agents/tasks/add', data)
+        return answer['task_id']
+    except Exception as e:
+        print('connection error', e)
+
+
+async def send_order(contract_id, order, receiver_id=None, params=None):
+    data = order_data(contract_id, order, receiver_id, params)
+
+    try:
+        return order_result(await post('/api/agents/order', data))
+    except Exception as e:
+        print('connection error', e)
+        return 0
+
+
+async def make_task(contract_id, task_id):
+    data = task_action_data(contract_id, task_id)
+
+    try:
+        answer = await post('/api/agents/tasks/done', data)
+        return answer['is_done']
+    except Exception as e:
+        print('connection error', e)
+
+
+async def delete_task(contract_id, task_id):
+    data = task_action_data(contract_id, task_id)
+
+    try:
+        await post('/api/agents/tasks/delete', data)
+    except Exception as e:
+        print('connection error', e)
@@ -0,0 +1,114 @@
+# Local stand-in for MAIN_HOST with configurable latency and error rate.
+#
+#   python benchmarks/fake_medsenger.py --port 18555 --latency 50 --jitter 20 --error-rate 0.01
+#
+# Point MAIN_HOST in config.py at it (http://127.0.0.1:18555). Can also be started in-process with start().
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Settings:
+    latency = 0
+    jitter = 0
+    error_rate = 0
+
+
+calls = {}
+calls_lock = threading.Lock()
+task_ids = iter(range(1, 10 ** 9))
+
+
+def records(data):
+    # a reading every 12 hours, slightly drifting, starting at the requested time
+    now = int(time.time())
+    since = max(int(data.get('from') or 0), now - 60 * 60 * 24 * 14)
+    base = 60 + int(data.get('contract_id') or 0) % 20
+    return {"values": [{"value": round(base + (timestamp % 7) / 10, 1), "timestamp": timestamp}
+                       for timestamp in range(since - since % (60 * 60 * 12) + 60 * 60 * 12, now, 60 * 60 * 12)]}
+
+
+def answer(path, data):
+    if path.endswith('/order'):
+        return {"delivered": 1, "receivers": 1}
+    if path.endswith('/records/get'):
+        return records(data)
+    if path.endswith('/records/categories') or path.endswith('/records/available_categories'):
+        return [{"name": "weight"}, {"name": "waist_circumference"}]
+    if path.endswith('/tasks/add'):
+        return {"task_id": next(task_ids)}
+    if path.endswith('/tasks/done'):
+        return {"is_done": True}
+    return {}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        data = json.loads(body) if body else {}
+
+        with calls_lock:
+            calls[self.path] = calls.get(self.path, 0) + 1
+
+        delay = Settings.latency + random.uniform(-Settings.jitter, Settings.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        if random.random() < Settings.error_rate:
+            status, payload = 500, {"error": "fake failure"}
+        else:
+            status, payload = 200, answer(self.path, data)
+
+        out = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    # the default listen backlog of 5 turns a burst of async connects into connection timeouts
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start(port=18555, latency=0, jitter=0, error_rate=0):
+    Settings.latency, Settings.jitter, Settings.error_rate = latency, jitter, error_rate
+
+    server = Server(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Medsenger agents API')
+    parser.add_argument('--port', type=int, default=18555)
+    parser.add_argument('--latency', type=float, default=0, help='mean response delay, ms')
+    parser.add_argument('--jitter', type=float, default=0, help='uniform +- jitter around the latency, ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of requests answered with HTTP 500')
+    args = parser.parse_args()
+
+    start(args.port, args.latency, args.jitter, args.error_rate)
+    print('fake Medsenger on port {} (latency {} ms +- {}, error rate {})'.format(args.port, args.latency, args.jitter,
+                                                                                   args.error_rate))
+    try:
+        while True:
+            time.sleep(60)
+            with calls_lock:
+                print(json.dumps(calls, sort_keys=True))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+# Replays webhook traffic against the Flask endpoints and reports sustained requests per second and tail latency.
+#
+#   python benchmarks/load_test.py --generate 2000 --save traffic.jsonl --uwsgi --processes 4 --fake --concurrency 16
+#   python benchmarks/load_test.py --traffic traffic.jsonl --url http://127.0.0.1:9090 --rate 50
+#
+# Traffic is JSON lines of {"method", "path", "args", "json" | "form"}. With --uwsgi the app is started from
+# pregnancy.ini on an HTTP socket (--processes overrides the ini), with --fake the fake Medsenger server answers
+# MAIN_HOST, so config.py should point MAIN_HOST at 127.0.0.1 and DB_* at a scratch database.
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+RISK_CODES = ['risk_gv', 'risk_vrt', 'risk_pe', 'risk_sa', 'risk_pr', 'risk_gbp', 'voming', 'heartburn', 'hemorrhoids']
+SYMPTOMS = ['headache', 'vomiting', 'stomachache', 'vision_problems', 'itching', 'swelling', 'liquid_discharge',
+            'blood_discharge']
+
+
+def generate(count, api_key, first_contract=1000000):
+    # a connect-heavy mix: every contract is created first, then used through the settings and the questionnaire
+    traffic = []
+    contracts = []
+
+    while len(traffic) < count:
+        roll = random.random()
+        if not contracts or roll < 0.15:
+            contract_id = first_contract + len(contracts)
+            contracts.append(contract_id)
+            params = {code: True for code in random.sample(RISK_CODES, random.randint(0, 2))}
+            params['week'] = random.randint(1, 40)
+            traffic.append({"method": "POST", "path": "/init",
+                            "json": {"api_key": api_key, "contract_id": contract_id, "preset": "pregnancy",
+                                     "params": params}})
+            continue
+
+        contract_id = random.choice(contracts)
+        args = {"api_key": api_key, "contract_id": contract_id}
+        if roll < 0.25:
+            traffic.append({"method": "POST", "path": "/status", "json": {"api_key": api_key}})
+        elif roll < 0.4:
+            traffic.append({"method": "GET", "path": "/settings", "args": args})
+        elif roll < 0.5:
+            traffic.append({"method": "POST", "path": "/settings", "args": args,
+                            "form": {"week": str(random.randint(1, 40))}})
+        elif roll < 0.7:
+            traffic.append({"method": "GET", "path": "/frame", "args": args})
+        elif roll < 0.97:
+            traffic.append({"method": "POST", "path": "/frame", "args": args,
+                            "form": {symptom: random.choice(['warning', 'ok']) for symptom in SYMPTOMS}})
+        else:
+            traffic.append({"method": "POST", "path": "/remove", "json": {"api_key": api_key,
+                                                                          "contract_id": contract_id}})
+
+    return traffic
+
+
+def load(path, api_key=None):
+    traffic = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if api_key:
+                for part in ['args', 'json']:
+                    if isinstance(entry.get(part), dict) and 'api_key' in entry[part]:
+                        entry[part]['api_key'] = api_key
+            traffic.append(entry)
+    return traffic
+
+
+local = threading.local()
+
+
+def send(url, entry):
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+
+    started = time.time()
+    try:
+        response = local.session.request(entry['method'], url + entry['path'], params=entry.get('args'),
+                                         json=entry.get('json'), data=entry.get('form'), timeout=60)
+        error = response.status_code >= 400 or response.text.strip() in ['error', 'invalid key']
+    except Exception:
+        error = True
+    return entry['method'] + ' ' + entry['path'], time.time() - started, error
+
+
+def replay(url, traffic, concurrency, rate=None):
+    started = time.time()
+
+    def paced(index, entry):
+        if rate:
+            delay = started + index / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return send(url, entry)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda job: paced(*job), enumerate(traffic)))
+
+    return results, time.time() - started
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0
+
+
+def report(results, duration):
+    routes = {}
+    for route, latency, error in results:
+        routes.setdefault(route, []).append((latency, error))
+    routes['total'] = [(latency, error) for route, latency, error in results]
+
+    print('{:<16} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}'.format('route', 'count', 'errors', 'rps', 'p50', 'p90',
+                                                                      'p99', 'max'))
+    for route, samples in sorted(routes.items(), key=lambda item: item[0] == 'total'):
+        latencies = [latency for latency, error in samples]
+        print('{:<16} {:>7} {:>7} {:>9.1f} {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms {:>7.1f}ms'.format(
+            route, len(samples), sum(1 for latency, error in samples if error), len(samples) / duration,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000, max(latencies) * 1000))
+
+
+def start_uwsgi(port, processes):
+    command = ['uwsgi', '--ini', 'pregnancy.ini', '--http-socket', '127.0.0.1:{}'.format(port)]
+    if processes:
+        command += ['--processes', str(processes)]
+    process = subprocess.Popen(command, cwd=ROOT)
+
+    # the app is loaded lazily per worker, wait until one answers
+    for attempt in range(120):
+        try:
+            requests.get('http://127.0.0.1:{}/'.format(port), timeout=1)
+            return process
+        except Exception:
+            time.sleep(0.5)
+
+    process.terminate()
+    raise RuntimeError('uwsgi did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP load test for the bot endpoints')
+    parser.add_argument('--traffic', help='JSON lines file to replay')
+    parser.add_argument('--generate', type=int, help='synthesize this many requests instead')
+    parser.add_argument('--save', help='write the generated traffic here for later replays')
+    parser.add_argument('--api-key', help='replaces api_key in the traffic, APP_KEY from config.py by default')
+    parser.add_argument('--url', default='http://127.0.0.1:9090')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rate', type=float, help='open-loop requests per second, as fast as possible if omitted')
+    parser.add_argument('--uwsgi', action='store_true', help='start uwsgi from pregnancy.ini on the --url port')
+    parser.add_argument('--processes', type=int, help='uwsgi processes, overrides pregnancy.ini')
+    parser.add_argument('--fake', action='store_true', help='start the fake Medsenger server on the MAIN_HOST port')
+    parser.add_argument('--latency', type=float, default=0, help='fake Medsenger response delay, ms')
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    api_key = args.api_key
+    if not api_key or args.fake:
+        from config import APP_KEY, MAIN_HOST
+        api_key = api_key or APP_KEY
+
+    if args.generate:
+        traffic = generate(args.generate, api_key)
+    elif args.traffic:
+        traffic = load(args.traffic, api_key)
+    else:
+        parser.error('either --traffic or --generate is required')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            for entry in traffic:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    if args.fake:
+        import fake_medsenger
+        fake_medsenger.start(urlparse(MAIN_HOST).port, args.latency, 0, args.error_rate)
+
+    server = start_uwsgi(urlparse(args.url).port, args.processes) if args.uwsgi else None
+    try:
+        print('{} requests, concurrency {}, rate {}'.format(len(traffic), args.concurrency, args.rate or 'max'))
+        results, duration = replay(args.url.rstrip('/'), traffic, args.concurrency, args.rate)
+        print('{:.1f}s, {:.1f} requests per second sustained'.format(duration, len(results) / duration))
+        report(results, duration)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
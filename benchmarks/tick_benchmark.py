@@ -0,0 +1,123 @@
+# Throughput and per-contract latency of tasks() against the fake Medsenger server.
+#
+#   python benchmarks/tick_benchmark.py --sizes 1000 10000 100000 --latency 50 --jitter 20
+#
+# Uses config.py: DB_* must point at a scratch database (contracts are wiped between sizes) and MAIN_HOST at
+# http://127.0.0.1:<port>, where the fake server is started in-process. The catalog is loaded with setup.py first.
+# Every size is ticked twice: "initial" starts the orders of fresh contracts, "steady" is a tick with nothing new.
+# TASKS_TICK_BUDGET is turned off, so every tick covers all contracts.
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+from urllib.parse import urlparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_medsenger
+
+CONTRACT_TABLES = ['order_digest', 'alert_state', 'symptom_report', 'outbox_message', 'measurement_record',
+                   'measurement_sync', 'current_order', 'done_order', 'contract_risk', 'contract']
+
+
+def percentile(values, share):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def reset_contracts(pb):
+    for table in CONTRACT_TABLES:
+        pb.db.session.execute(pb.text('DELETE FROM {}'.format(table)))
+    pb.db.session.commit()
+    pb.measurement_stats.series.clear()
+    pb.resume_cursors.clear()
+
+
+def seed_contracts(pb, count, first_id=1):
+    risks = pb.Risk.query.all()
+    now = int(time.time())
+    contracts, contract_risks = [], []
+
+    for contract_id in range(first_id, first_id + count):
+        week = random.randint(1, 42)
+        chosen = random.sample(risks, random.randint(0, min(2, len(risks))))
+        contracts.append({"id": contract_id, "active": True, "is_born": random.random() < 0.1,
+                          "start": now - week * pb.WEEK - random.randint(0, pb.WEEK - 1),
+                          "risk_mask": sum(risk.mask for risk in chosen), "next_check": None})
+        contract_risks += [{"contract_id": contract_id, "risk_id": risk.id} for risk in chosen]
+
+    for offset in range(0, len(contracts), 5000):
+        pb.db.session.execute(pb.Contract.__table__.insert(), contracts[offset:offset + 5000])
+    for offset in range(0, len(contract_risks), 5000):
+        pb.db.session.execute(pb.ContractRisk.__table__.insert(), contract_risks[offset:offset + 5000])
+    pb.db.session.commit()
+
+
+def run_tick(pb, name):
+    with pb.tracing.tick(name) as tick:
+        started = time.time()
+        if pb.TASKS_DRIVER == 'async':
+            asyncio.run(pb.tasks_async())
+        else:
+            pb.tasks()
+        duration = time.time() - started
+
+    latencies = [trace.total for trace in tick.contracts.values()]
+    return duration, latencies
+
+
+def report(name, size, duration, latencies, calls):
+    print('{:>8} {:<8} {:>9.1f}s {:>10.1f}/s {:>9.1f}ms {:>9.1f}ms {:>10}'.format(
+        size, name, duration, size / duration if duration else 0, percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000, calls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='tasks() benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0, help='fake Medsenger response delay, ms')
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--driver', choices=['threads', 'async'], default=None, help='overrides TASKS_DRIVER')
+    parser.add_argument('--no-catalog', action='store_true', help='do not run setup.py first')
+    args = parser.parse_args()
+
+    if not args.no_catalog:
+        subprocess.check_call([sys.executable, 'setup.py'], cwd=ROOT)
+
+    import pregnancy_bot as pb
+
+    # per-contract latencies are taken from the tick trace
+    pb.tracing.TRACE_ENABLED = True
+    pb.TASKS_TICK_BUDGET = 0
+    if args.driver:
+        pb.TASKS_DRIVER = args.driver
+
+    fake_medsenger.start(urlparse(pb.MAIN_HOST).port, args.latency, args.jitter, args.error_rate)
+
+    print('driver {}, fake latency {} ms +- {}, error rate {}'.format(pb.TASKS_DRIVER, args.latency, args.jitter,
+                                                                       args.error_rate))
+    print('{:>8} {:<8} {:>10} {:>12} {:>11} {:>11} {:>10}'.format('size', 'tick', 'duration', 'throughput', 'p50',
+                                                                   'p99', 'api calls'))
+
+    for size in args.sizes:
+        with pb.app.app_context():
+            reset_contracts(pb)
+            seed_contracts(pb, size)
+
+            for name in ['initial', 'steady']:
+                before = sum(fake_medsenger.calls.values())
+                duration, latencies = run_tick(pb, name)
+                report(name, size, duration, latencies, sum(fake_medsenger.calls.values()) - before)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+from config import *
+import threading
+import json
+import time
+import os
+
+# Counters and latency histograms in Prometheus text format. uwsgi workers and the jobs process each keep their own
+# registry and dump it to METRICS_DIR on a timer; /metrics adds up the dumps of every live process.
+
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+counters = {}
+histograms = {}
+lock = threading.Lock()
+flusher_lock = threading.Lock()
+flusher_pid = None
+
+
+def key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def increment(name, labels=None, amount=1):
+    with lock:
+        counter = key(name, labels)
+        counters[counter] = counters.get(counter, 0) + amount
+    maybe_flush()
+
+
+def observe(name, value, labels=None):
+    with lock:
+        histogram = histograms.setdefault(key(name, labels), {"buckets": [0] * len(BUCKETS), "sum": 0, "count": 0})
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+    maybe_flush()
+
+
+class Timer:
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.name, time.time() - self.started, self.labels)
+
+
+def snapshot():
+    with lock:
+        return {
+            "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+            "histograms": [[name, list(labels), dict(histogram, buckets=list(histogram['buckets']))]
+                           for (name, labels), histogram in histograms.items()],
+        }
+
+
+def snapshot_path():
+    return os.path.join(METRICS_DIR, '{}.json'.format(os.getpid()))
+
+
+def flush():
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = snapshot_path()
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot(), f)
+        os.replace(path + '.tmp', path)
+    except Exception as e:
+        print('metrics flush error', e)
+
+
+def flusher():
+    # an idle process keeps rewriting its dump, so its counters are never taken for gone
+    while True:
+        flush()
+        time.sleep(METRICS_FLUSH_INTERVAL)
+
+
+def maybe_flush():
+    # uwsgi forks workers after the import, so every process starts its own flusher on its first metric
+    global flusher_pid
+
+    if not METRICS_DIR or flusher_pid == os.getpid():
+        return
+
+    with flusher_lock:
+        if flusher_pid != os.getpid():
+            flusher_pid = os.getpid()
+            threading.Thread(target=flusher, daemon=True).start()
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect():
+    # this process is read live, the others from their latest dumps; dumps of exited processes are removed
+    snapshots = [snapshot()]
+
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        own = os.path.basename(snapshot_path())
+        for name in os.listdir(METRICS_DIR):
+            path = os.path.join(METRICS_DIR, name)
+            if not name.endswith('.json') or name == own:
+                continue
+            try:
+                if not alive(int(name[:-len('.json')])):
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except Exception as e:
+                print('metrics read error', name, e)
+
+    merged_counters = {}
+    merged_histograms = {}
+    for data in snapshots:
+        for name, labels, value in data['counters']:
+            counter = (name, tuple(tuple(label) for label in labels))
+            merged_counters[counter] = merged_counters.get(counter, 0) + value
+        for name, labels, histogram in data['histograms']:
+            merged = merged_histograms.setdefault((name, tuple(tuple(label) for label in labels)),
+                                                  {"buckets": [0] * len(BUCKETS), "sum": 0, "count": 0})
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+            merged['sum'] += histogram['sum']
+            merged['count'] += histogram['count']
+
+    return merged_counters, merged_histograms
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in labels) + '}'
+
+
+def render():
+    merged_counters, merged_histograms = collect()
+    lines = []
+
+    for name in sorted(set(name for name, labels in merged_counters)):
+        lines.append('# TYPE {} counter'.format(name))
+        for (counter_name, labels), value in sorted(merged_counters.items()):
+            if counter_name == name:
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+    for name in sorted(set(name for name, labels in merged_histograms)):
+        lines.append('# TYPE {} histogram'.format(name))
+        for (histogram_name, labels), histogram in sorted(merged_histograms.items()):
+            if histogram_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, format_labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), round(histogram['sum'], 6)))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram['count']))
+
+    return '\n'.join(lines) + '\n'
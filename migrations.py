@@ -0,0 +1,117 @@
+from sqlalchemy import inspect, text
+import datetime
+
+# create_all only creates missing tables; every change to an existing table goes through a numbered step below.
+# Pending steps run in order inside one transaction and are recorded in schema_migration.
+# They must stay safe on a database that create_all has just built from the current models.
+
+MIGRATION_LOCK_KEY = 7030
+
+
+def columns(connection, table):
+    return [column['name'] for column in inspect(connection).get_columns(table)]
+
+
+def add_column(connection, table, column, column_type):
+    if column in columns(connection, table):
+        return False
+
+    connection.execute(text('ALTER TABLE "{}" ADD COLUMN {} {}'.format(table, column, column_type)))
+    return True
+
+
+def create_index(connection, name, table, *index_columns):
+    connection.execute(text('CREATE INDEX IF NOT EXISTS {} ON "{}" ({})'.format(name, table, ', '.join(index_columns))))
+
+
+def sync_risk_masks(connection):
+    # rebuilds bits and masks from the association tables
+    connection.execute(text("""
+        UPDATE risk SET bit = numbered.n
+        FROM (SELECT id, row_number() OVER (ORDER BY id) - 1 AS n FROM risk) numbered
+        WHERE risk.id = numbered.id AND NOT EXISTS (SELECT 1 FROM risk WHERE bit IS NOT NULL)
+    """))
+    connection.execute(text("""
+        UPDATE "order" SET risk_mask = COALESCE((
+            SELECT bit_or(1::bigint << risk.bit) FROM order_risk JOIN risk ON risk.id = order_risk.risk_id
+            WHERE order_risk.order_id = "order".id), 0)
+    """))
+    connection.execute(text("""
+        UPDATE contract SET risk_mask = COALESCE((
+            SELECT bit_or(1::bigint << risk.bit) FROM contract_risk JOIN risk ON risk.id = contract_risk.risk_id
+            WHERE contract_risk.contract_id = contract.id), 0)
+    """))
+
+
+def risk_masks(connection):
+    added = add_column(connection, 'risk', 'bit', 'INTEGER UNIQUE')
+    added = add_column(connection, 'order', 'risk_mask', 'BIGINT DEFAULT 0') or added
+    added = add_column(connection, 'contract', 'risk_mask', 'BIGINT DEFAULT 0') or added
+
+    if added:
+        sync_risk_masks(connection)
+
+
+def contract_next_check(connection):
+    add_column(connection, 'contract', 'next_check', 'INTEGER')
+    create_index(connection, 'ix_contract_next_check', 'contract', 'next_check')
+
+
+def contract_fingerprint(connection):
+    add_column(connection, 'contract', 'fingerprint', 'VARCHAR(64)')
+
+
+def hot_path_indexes(connection):
+    # tasks() scans active contracts, /init and setup.py look risks up by code,
+    # deleting or editing an order looks its assignments up by order_id
+    create_index(connection, 'ix_contract_active_start', 'contract', 'active', 'start')
+    create_index(connection, 'ix_risk_code', 'risk', 'code')
+    create_index(connection, 'ix_current_order_order_id', 'current_order', 'order_id')
+    create_index(connection, 'ix_done_order_order_id', 'done_order', 'order_id')
+    create_index(connection, 'ix_contract_risk_risk_id', 'contract_risk', 'risk_id')
+    create_index(connection, 'ix_order_risk_risk_id', 'order_risk', 'risk_id')
+
+
+def order_code(connection):
+    # stable key for the catalog loader in setup.py, retired orders stay for contracts that still run them
+    add_column(connection, 'order', 'code', 'VARCHAR(255)')
+    add_column(connection, 'order', 'retired', 'BOOLEAN DEFAULT false')
+    connection.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_order_code ON "order" (code)'))
+
+
+MIGRATIONS = [
+    (1, 'risk bits and risk masks', risk_masks),
+    (2, 'contract next_check', contract_next_check),
+    (3, 'contract fingerprint', contract_fingerprint),
+    (4, 'hot path indexes', hot_path_indexes),
+    (5, 'order code and retired flag', order_code),
+]
+
+
+def applied_migrations(connection):
+    connection.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migration (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(255),
+            applied_on TIMESTAMP
+        )
+    """))
+    return set(connection.execute(text('SELECT version FROM schema_migration')).scalars())
+
+
+def migrate(engine):
+    with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            # web and jobs processes start together, only one of them migrates
+            connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {"key": MIGRATION_LOCK_KEY})
+
+        applied = applied_migrations(connection)
+        for version, name, step in MIGRATIONS:
+            if version in applied:
+                continue
+
+            step(connection)
+            connection.execute(text('INSERT INTO schema_migration (version, name, applied_on) '
+                                    'VALUES (:version, :name, :applied_on)'),
+                               {"version": version, "name": name, "applied_on": datetime.datetime.now()})
+            print('migration {} ({}) applied'.format(version, name))
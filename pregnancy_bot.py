@@ -1,13 +1,26 @@
 import json
 import time
 from threading import Thread
-from flask import Flask, request, render_template
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from flask import Flask, request, render_template, g
 from config import *
 import threading
 import datetime
 from flask_sqlalchemy import SQLAlchemy
 import agents_api
+import agents_api_async
+import metrics
+import tracing
+import contextvars
+import asyncio
 import os, sys
+import bisect
+import select
+from sqlalchemy import event, or_, text
+from sqlalchemy.orm import Session, selectinload
+from rolling_stats import RollingStore
+from wake_queue import WakeQueue
+from migrations import migrate
 
 app = Flask(__name__)
 db_string = "postgresql://{}:{}@{}:{}/{}".format(DB_LOGIN, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE)
@@ -15,15 +28,46 @@ app.config['SQLALCHEMY_DATABASE_URI'] = db_string
 db = SQLAlchemy(app)
 
 
+WEEK = 60 * 60 * 24 * 7
+NO_WAKEUP = 2 ** 31 - 1
+
+
 class Risk(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(512))
     comment = db.Column(db.String(512), nullable=True)
-    code = db.Column(db.String(512), nullable=True)
+    code = db.Column(db.String(512), nullable=True, index=True)
+    bit = db.Column(db.Integer, nullable=True, unique=True)
+
+    @property
+    def mask(self):
+        return 1 << self.bit if self.bit is not None else 0
+
+
+class OrderActions:
+    def run(self, contract_id):
+        with tracing.span('send_order', self.id, 'start'):
+            return agents_api.send_order(contract_id, self.start_order, MONITORING_ID, self.start_params) == 1
+
+    def stop(self, contract_id):
+        with tracing.span('send_order', self.id, 'stop'):
+            return agents_api.send_order(contract_id, self.end_order, MONITORING_ID, self.end_params) == 1
+
+    async def run_async(self, contract_id):
+        with tracing.span('send_order', self.id, 'start'):
+            return await agents_api_async.send_order(contract_id, self.start_order, MONITORING_ID,
+                                                     self.start_params) == 1
+
+    async def stop_async(self, contract_id):
+        with tracing.span('send_order', self.id, 'stop'):
+            return await agents_api_async.send_order(contract_id, self.end_order, MONITORING_ID,
+                                                     self.end_params) == 1
 
 
-class Order(db.Model):
+class Order(db.Model, OrderActions):
     id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(255), nullable=True, unique=True, index=True)
+    retired = db.Column(db.Boolean, default=False)
     start_order = db.Column(db.String(255))
     start_params = db.Column(db.JSON, nullable=True)
     end_order = db.Column(db.String(255))
@@ -32,13 +76,13 @@ class Order(db.Model):
     end_week = db.Column(db.Integer, nullable=True)
     after_birth = db.Column(db.Boolean, default=True)
     risks = db.relationship('Risk', secondary='order_risk')
+    risk_mask = db.Column(db.BigInteger, default=0)
     comment = db.Column(db.Text, nullable=True)
 
-    def run(self, contract):
-        return agents_api.send_order(contract.id, self.start_order, MONITORING_ID, self.start_params) == 1
 
-    def stop(self, contract):
-        return agents_api.send_order(contract.id, self.end_order, MONITORING_ID, self.end_params) == 1
+class CatalogVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0)
 
 
 class Contract(db.Model):
@@ -46,6 +90,9 @@ class Contract(db.Model):
     active = db.Column(db.Boolean, default=True)
     is_born = db.Column(db.Boolean, default=False)
     start = db.Column(db.Integer, nullable=True)
+    risk_mask = db.Column(db.BigInteger, default=0)
+    next_check = db.Column(db.Integer, nullable=True, index=True)
+    fingerprint = db.Column(db.String(64), nullable=True)
     created_on = db.Column(db.DateTime, server_default=db.func.now())
     updated_on = db.Column(db.DateTime, server_default=db.func.now(), server_onupdate=db.func.now())
 
@@ -53,149 +100,373 @@ class Contract(db.Model):
     done_orders = db.relationship('Order', secondary='done_order')
     risks = db.relationship('Risk', secondary='contract_risk')
 
+    __table_args__ = (db.Index('ix_contract_active_start', 'active', 'start'),)
+
     def week(self):
         if not self.start:
             return None
-        return int((time.time() - self.start) // (60 * 60 * 24 * 7))
+        return int((time.time() - self.start) // WEEK)
 
-    def remove_order(self, order):
-        if order.stop(self):
-            self.current_orders.remove(order)
-            self.done_orders.append(order)
-            return True
-        return False
+    def orders_due(self, now):
+        return self.next_check is None or self.next_check <= now
 
-    def add_order(self, order):
-        if order.run(self):
-            self.current_orders.append(order)
-            return True
-        return False
+    def evaluation_fingerprint(self, catalog):
+        # everything plan_orders depends on besides the current orders themselves
+        return "{}:{}:{}:{}".format(self.week(), int(bool(self.is_born)), self.risk_mask or 0, catalog.version)
+
+    def next_wakeup(self, catalog):
+        # the next moment the set of eligible orders can change without a settings event
+        if not self.start or self.is_born:
+            return NO_WAKEUP
+
+        week = self.week()
+        boundary = catalog.next_boundary(week) if week else 1
+        if boundary is None:
+            return NO_WAKEUP
+
+        return self.start + boundary * WEEK
 
     def check_risks(self, order):
-        if not order.risks:
+        if not order.risk_mask:
             return True
 
-        for risk in self.risks:
-            if risk in order.risks:
-                return True
+        return bool((self.risk_mask or 0) & order.risk_mask)
 
-        return False
+    def plan_orders(self, catalog):
+        to_stop = []
+        to_start = []
 
-    def check_orders(self):
+        week = self.week()
+        if not week:
+            return to_stop, to_start
 
-        try:
-            new_orders = []
-            old_orders = []
+        current_ids = set()
 
-            if not self.week():
-                return
+        for order in self.current_orders:
+            current_ids.add(order.id)
+            entry = catalog.orders.get(order.id)
+            if not entry:
+                # retired from the catalog
+                to_stop.append(CatalogOrder(order))
+                continue
 
-            for order in self.current_orders:
-                criteria = [self.is_born and not order.after_birth, order.end_week and self.week() > order.end_week,self.week() < order.start_week,
-                            not self.check_risks(order)]
-                if True in criteria and self.remove_order(order):
-                    old_orders.append(order.comment)
+            criteria = [self.is_born and not entry.after_birth, entry.end_week and week > entry.end_week,
+                        week < entry.start_week, not self.check_risks(entry)]
+            if True in criteria:
+                to_stop.append(entry)
 
-            for order in Order.query.all():
-                if order in self.current_orders:
-                    continue
+        for order in catalog.eligible(week, self.is_born):
+            if order.id not in current_ids and self.check_risks(order):
+                to_start.append(order)
 
-                if self.is_born and not order.after_birth:
-                    continue
+        return to_stop, to_start
+
+    def apply_orders(self, stopped, started):
+        for entry in stopped:
+            order = Order.query.get(entry.id)
+            self.current_orders.remove(order)
+            self.done_orders.append(order)
 
-                if order.after_birth and self.is_born and self.check_risks(order) and self.add_order(order):
-                        new_orders.append(order.comment)
-                elif self.week() >= order.start_week and self.week() <= order.end_week and self.check_risks(
-                            order) and self.add_order(order):
-                        new_orders.append(order.comment)
-            if new_orders + old_orders:
-                send_orders_warning(self, new_orders, old_orders)
+        for entry in started:
+            self.current_orders.append(Order.query.get(entry.id))
 
-            db.session.commit()
+        if stopped or started:
+            send_orders_warning(self.id, [entry.comment for entry in started], [entry.comment for entry in stopped])
+
+    def mark_evaluated(self, catalog, succeeded=True):
+        if succeeded:
+            self.next_check = self.next_wakeup(catalog)
+            self.fingerprint = self.evaluation_fingerprint(catalog)
+        else:
+            self.next_check = int(time.time()) + ORDER_RETRY_DELAY
+            self.fingerprint = None
+
+    def check_orders(self, catalog=None, commit=True):
+
+        try:
+            with tracing.contract(self.id):
+                if catalog is None:
+                    catalog = get_catalog()
+
+                with tracing.span('db'):
+                    to_stop, to_start = self.plan_orders(catalog)
+                stopped, started = [], []
+                if to_stop or to_start:
+                    stopped, started = execute_orders(self.id, to_stop, to_start)
+                    with tracing.span('db'):
+                        self.apply_orders(stopped, started)
+                self.mark_evaluated(catalog, len(stopped) == len(to_stop) and len(started) == len(to_start))
+
+                if commit:
+                    with tracing.span('commit'):
+                        notify_wakeup(self.id, self.next_check)
+                        db.session.commit()
         except Exception as e:
             exc_type, exc_obj, exc_tb = sys.exc_info()
             fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
             print(exc_type, fname, exc_tb.tb_lineno)
             print(e)
 
-    def check_measurements(self):
 
-        # control weight
-        time_to = int(time.time()) - 60 * 60 * 24 * 4
-        time_from = int(time.time()) - 60 * 60 * 24 * 11
-
-        start_time = int(time.time()) - 60 * 60
+class CurrentOrder(db.Model):
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), primary_key=True, index=True)
+    created_on = db.Column(db.DateTime, server_default=db.func.now())
+    updated_on = db.Column(db.DateTime, server_default=db.func.now(), server_onupdate=db.func.now())
 
-        if self.week() >= 14 and not self.is_born:
 
-            # control weight
-            try:
-                last_value = agents_api.get_records(self.id, 'weight', limit=1, time_from=start_time)['values'][0]['value']
-                week_value = [record['value'] for record in
-                              agents_api.get_records(self.id, 'weight', time_from=time_from, time_to=time_to)['values']]
+class DoneOrder(db.Model):
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), primary_key=True, index=True)
+    created_on = db.Column(db.DateTime, server_default=db.func.now())
+    updated_on = db.Column(db.DateTime, server_default=db.func.now(), server_onupdate=db.func.now())
 
-                delta = last_value - sum(week_value) / len(week_value)
-                if delta >= 1:
-                    send_warning_to_doctor(self.id,
-                                           "Предупреждение: последнее значение веса ({} кг) беременной превышает среднее за прошлую неделю ({} кг) на {} кг.".format(
-                                               last_value, week_value, delta))
 
-            except Exception as e:
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                print(exc_type, fname, exc_tb.tb_lineno)
-                print(e)
+class OutboxMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'))
+    params = db.Column(db.JSON)
+    sent = db.Column(db.Boolean, default=False)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.Integer, nullable=True, index=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_on = db.Column(db.DateTime, server_default=db.func.now())
+    sent_on = db.Column(db.DateTime, nullable=True)
 
-            try:
-                last_value = \
-                    agents_api.get_records(self.id, 'waist_circumference', limit=2, time_from=start_time)['values'][0][
-                        'value']
-                week_value = [record['value'] for record in
-                              agents_api.get_records(self.id, 'waist_circumference', time_from=time_from, time_to=time_to)[
-                                  'values']]
 
-                if week_value:
-                    delta = last_value - sum(week_value) / len(week_value)
-                    if delta <= 1:
-                        send_warning_to_doctor(self.id,
-                                               "Предупреждение: последнее обхвата талии ({} см) беременной по сравнению со средним за прошлую неделю ({} см) изменилось всего на {} см.".format(
-                                                   last_value, week_value, delta))
+class OrderDigest(db.Model):
+    # order changes of one contract waiting to be announced together
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), primary_key=True)
+    started = db.Column(db.JSON)
+    stopped = db.Column(db.JSON)
+    send_after = db.Column(db.Integer, index=True)
 
 
-            except Exception as e:
-                print(e)
+class AlertState(db.Model):
+    # the last alert of a measurement rule, so a lasting condition is reported once and not on every tick
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), primary_key=True)
+    rule = db.Column(db.String(64), primary_key=True)
+    record_timestamp = db.Column(db.Integer)
+    active = db.Column(db.Boolean, default=False)
+    fired_at = db.Column(db.Integer, nullable=True)
+    suppressed_until = db.Column(db.Integer, nullable=True)
+    cleared_at = db.Column(db.Integer, nullable=True)
 
 
-class CurrentOrder(db.Model):
-    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), primary_key=True)
+class SymptomReport(db.Model):
+    # a /frame submission, acknowledged right away and uploaded to Medsenger in the background
+    id = db.Column(db.Integer, primary_key=True)
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), index=True)
+    values = db.Column(db.JSON)
+    status = db.Column(db.String(16), default='pending')
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.Integer, nullable=True, index=True)
+    last_error = db.Column(db.Text, nullable=True)
     created_on = db.Column(db.DateTime, server_default=db.func.now())
-    updated_on = db.Column(db.DateTime, server_default=db.func.now(), server_onupdate=db.func.now())
+    processed_on = db.Column(db.DateTime, nullable=True)
 
 
-class DoneOrder(db.Model):
+class MeasurementRecord(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'))
+    category = db.Column(db.String(255))
+    value = db.Column(db.Float)
+    timestamp = db.Column(db.Integer)
+
+    __table_args__ = (db.Index('ix_measurement_record_contract', 'contract_id', 'category', 'timestamp'),)
+
+
+class MeasurementSync(db.Model):
     contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), primary_key=True)
-    created_on = db.Column(db.DateTime, server_default=db.func.now())
-    updated_on = db.Column(db.DateTime, server_default=db.func.now(), server_onupdate=db.func.now())
+    category = db.Column(db.String(255), primary_key=True)
+    synced_until = db.Column(db.Integer, default=0)
 
 
 class ContractRisk(db.Model):
     contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), primary_key=True)
-    risk_id = db.Column(db.Integer, db.ForeignKey('risk.id'), primary_key=True)
+    risk_id = db.Column(db.Integer, db.ForeignKey('risk.id'), primary_key=True, index=True)
 
 
 class OrderRisk(db.Model):
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), primary_key=True)
-    risk_id = db.Column(db.Integer, db.ForeignKey('risk.id'), primary_key=True)
+    risk_id = db.Column(db.Integer, db.ForeignKey('risk.id'), primary_key=True, index=True)
+
+
+MAX_RISK_BITS = 63
+
+
+@event.listens_for(Session, 'before_flush')
+def assign_risk_bits(session, flush_context, instances):
+    new_risks = [obj for obj in session.new if isinstance(obj, Risk) and obj.bit is None]
+    if not new_risks:
+        return
+
+    next_bit = session.connection().execute(text('SELECT COALESCE(MAX(bit) + 1, 0) FROM risk')).scalar()
+    for risk in new_risks:
+        if next_bit >= MAX_RISK_BITS:
+            raise ValueError('risk bitmask is full, cannot assign a bit to {}'.format(risk.code))
+        risk.bit = next_bit
+        next_bit += 1
+
+
+@event.listens_for(Contract.risks, 'append')
+@event.listens_for(Order.risks, 'append')
+def risk_added(target, risk, initiator):
+    target.risk_mask = (target.risk_mask or 0) | risk.mask
+
+
+@event.listens_for(Contract.risks, 'remove')
+@event.listens_for(Order.risks, 'remove')
+def risk_removed(target, risk, initiator):
+    target.risk_mask = (target.risk_mask or 0) & ~risk.mask
 
 
 try:
     db.create_all()
+    migrate(db.engine)
 except:
     print('cant create structure')
 
 
+class CatalogOrder(OrderActions):
+    def __init__(self, order):
+        self.id = order.id
+        self.start_order = order.start_order
+        self.start_params = order.start_params
+        self.end_order = order.end_order
+        self.end_params = order.end_params
+        self.start_week = order.start_week
+        self.end_week = order.end_week
+        self.after_birth = order.after_birth
+        self.comment = order.comment
+        self.risk_mask = 0
+        for risk in order.risks:
+            self.risk_mask |= risk.mask
+
+
+class OrderCatalog:
+    def __init__(self, version, orders):
+        self.version = version
+        self.orders = {order.id: CatalogOrder(order) for order in orders}
+        self.build_index()
+
+    def build_index(self):
+        # orders applicable to each gestational week, plus a bucket for the period after birth
+        bounded = [order for order in self.orders.values() if order.end_week is not None]
+        last_week = max([order.end_week for order in bounded], default=-1)
+
+        self.by_week = [[] for _ in range(last_week + 1)]
+        for order in bounded:
+            for week in range(max(order.start_week or 0, 0), order.end_week + 1):
+                self.by_week[week].append(order)
+
+        self.open_ended = [order for order in self.orders.values() if order.end_week is None]
+        self.after_birth = [order for order in self.orders.values() if order.after_birth]
+
+        # weeks at which an order starts or stops applying
+        boundaries = set()
+        for order in self.orders.values():
+            boundaries.add(order.start_week or 0)
+            if order.end_week is not None:
+                boundaries.add(order.end_week + 1)
+        self.boundaries = sorted(boundaries)
+
+    def next_boundary(self, week):
+        index = bisect.bisect_right(self.boundaries, week)
+        return self.boundaries[index] if index < len(self.boundaries) else None
+
+    def eligible(self, week, is_born):
+        if is_born:
+            return self.after_birth
+
+        orders = self.by_week[week] if 0 <= week < len(self.by_week) else []
+        if self.open_ended:
+            orders = orders + [order for order in self.open_ended if week >= (order.start_week or 0)]
+        return orders
+
+
+catalog = None
+catalog_lock = threading.Lock()
+
+# latest version seen over NOTIFY, the version row is still polled in case a notification is missed
+announced_version = None
+announced_checked = 0
+catalog_listener_started = False
+
+
+def catalog_version():
+    row = CatalogVersion.query.get(1)
+    return row.version if row else 0
+
+
+def catalog_listener():
+    global announced_version, announced_checked
+    import psycopg2
+
+    while True:
+        try:
+            connection = psycopg2.connect(db_string)
+            connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            connection.cursor().execute('LISTEN catalog_version')
+
+            while True:
+                if select.select([connection], [], [], CATALOG_POLL_INTERVAL) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    announced_version = int(connection.notifies.pop(0).payload)
+                    announced_checked = time.time()
+        except Exception as e:
+            print('catalog listener error', e)
+            # notifications may have been missed while disconnected
+            announced_checked = 0
+            time.sleep(CATALOG_POLL_INTERVAL)
+
+
+def start_catalog_listener():
+    global catalog_listener_started
+
+    if catalog_listener_started or db.engine.dialect.name != 'postgresql':
+        return
+    catalog_listener_started = True
+    Thread(target=catalog_listener, daemon=True).start()
+
+
+def current_catalog_version():
+    global announced_version, announced_checked
+
+    start_catalog_listener()
+    if announced_version is None or time.time() - announced_checked >= CATALOG_POLL_INTERVAL:
+        announced_checked = time.time()
+        announced_version = catalog_version()
+    return announced_version
+
+
+def get_catalog():
+    # called once per request or tick; the caller keeps the returned snapshot, a reload swaps in a new object
+    global catalog, announced_version
+
+    version = current_catalog_version()
+    current = catalog
+    if current and current.version == version:
+        return current
+
+    # while one thread rebuilds, the others keep serving the previous version
+    if not catalog_lock.acquire(blocking=current is None):
+        return current
+
+    try:
+        if not catalog or catalog.version != version:
+            version = catalog_version()
+            orders = Order.query.filter(Order.retired == False).options(selectinload(Order.risks)).all()
+            catalog = OrderCatalog(version, orders)
+            announced_version = max(announced_version or 0, version)
+            print("{}: Catalog version {} loaded ({} orders)".format(gts(), version, len(orders)))
+        return catalog
+    finally:
+        catalog_lock.release()
+
+
 def delayed(delay, f, args):
     timer = threading.Timer(delay, f, args=args)
     timer.start()
@@ -222,6 +493,28 @@ def gts():
     return now.strftime("%Y-%m-%d %H:%M:%S")
 
 
+@app.before_request
+def start_timer():
+    g.started = time.time()
+
+
+@app.after_request
+def record_request(response):
+    if request.url_rule is not None and 'started' in g:
+        labels = {"route": request.url_rule.rule, "method": request.method}
+        metrics.observe('http_request_seconds', time.time() - g.started, labels)
+        metrics.increment('http_requests_total', dict(labels, status=response.status_code))
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    if request.args.get('api_key', '') != APP_KEY:
+        return 'invalid key'
+
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 @app.route('/status', methods=['POST'])
 def status():
     data = request.json
@@ -298,6 +591,7 @@ def remove():
 
         if contract:
             contract.active = False
+            notify_wakeup(contract.id, None)
             db.session.commit()
 
             print("{}: Deactivate contract {}".format(gts(), contract.id))
@@ -385,66 +679,812 @@ def index():
     return 'waiting for the thunder!'
 
 
-def send_warning_to_doctor(contract_id, a):
-    try:
-        agents_api.send_message(contract_id, text=a, is_urgent=True, only_doctor=True, need_answer=True)
-    except Exception as e:
-        print('connection error', e)
+def enqueue_message(contract_id, **params):
+    db.session.add(OutboxMessage(contract_id=contract_id, params=params, next_attempt=int(time.time())))
+
+
+def retry_later(item, error, now):
+    # exponential backoff shared by the outbox and symptom reports, returns False once the item is given up
+    item.attempts += 1
+    item.last_error = error
+    if item.attempts >= OUTBOX_MAX_ATTEMPTS:
+        item.next_attempt = None
+        return False
+
+    item.next_attempt = now + min(OUTBOX_RETRY_DELAY * 2 ** (item.attempts - 1), OUTBOX_MAX_RETRY_DELAY)
+    return True
+
+
+def dispatch_outbox(batch_size=OUTBOX_BATCH_SIZE, contract_id=None):
+    # SKIP LOCKED lets several dispatchers drain the table without sending a message twice
+    while True:
+        now = int(time.time())
+        query = OutboxMessage.query.filter(OutboxMessage.sent == False, OutboxMessage.next_attempt <= now)
+        if contract_id is not None:
+            query = query.filter(OutboxMessage.contract_id == contract_id)
+        messages = query.order_by(OutboxMessage.id).with_for_update(skip_locked=True).limit(batch_size).all()
+
+        if not messages:
+            db.session.commit()
+            return
 
+        with ThreadPoolExecutor(max_workers=OUTBOX_WORKERS) as executor:
+            errors = list(executor.map(deliver_message, [(message.contract_id, message.params) for message in messages]))
 
-def send_orders_warning(contract, a, b):
+        for message, error in zip(messages, errors):
+            if not error:
+                message.sent = True
+                message.sent_on = datetime.datetime.now()
+                message.next_attempt = None
+            elif not retry_later(message, error, now):
+                print("{}: Outbox message {} dropped after {} attempts: {}".format(gts(), message.id,
+                                                                                   message.attempts, error))
+
+        db.session.commit()
+
+
+def deliver_message(job):
+    contract_id, params = job
     try:
-        message = "В соответствии с протоколом ведения беременности "
-        if a:
-            message += "выполнены следующие назначения:\n - {}\n\n".format('\n - '.join(a))
-        if a and b:
-            message += "Также "
-        if b:
-            message += "отменены:\n - {}\n\n".format('\n - '.join(b))
-
-        doctor_message = message + 'Изменить назначения можно в настройках интеллектуального агента "Мониторинг медицинских измерений и приема препаратов". <a href="https://drive.google.com/file/d/1PM4qWP2Cfm1p5W2fqbFC8iZahe5nhtjB/view?usp=sharing">Подробная схема мониторинга.</a>'
-        patient_message = message + 'Если у вас возникнут вопросы, их можно задать вашему лечащему врачу в чате.'
-
-        agents_api.send_message(contract.id, text=doctor_message, only_doctor=True)
-        agents_api.send_message(contract.id, text=patient_message, only_patient=True)
+        agents_api.deliver_message(contract_id, **params)
     except Exception as e:
-        print('connection error', e)
+        return str(e) or e.__class__.__name__
 
 
-def send_warning(contract_id, a):
-    try:
-        if a:
-            agents_api.send_message(contract_id,
-                                    text="Беременная сообщила о следующих симптомах - {}.".format(' / '.join(a)),
-                                    is_urgent=True, only_doctor=True, need_answer=True)
-            agents_api.send_message(contract_id,
-                                    text="Спасибо за заполнение опросника! Мы уведомили вашего врача о симптомах, которые вызывают беспокойство на вашем сроке беременности ({}). Он свяжется с вами в ближайшее время.".format(' / '.join(a)),
-                                    is_urgent=True, only_patient=True)
+def outbox_sender():
+    while True:
+        flush_order_digests()
+        dispatch_outbox()
+        dispatch_reports()
+        time.sleep(OUTBOX_INTERVAL)
+
+
+def send_warning_to_doctor(contract_id, a):
+    enqueue_message(contract_id, text=a, is_urgent=True, only_doctor=True, need_answer=True)
+
+
+def orders_warning_messages(a, b):
+    message = "В соответствии с протоколом ведения беременности "
+    if a:
+        message += "выполнены следующие назначения:\n - {}\n\n".format('\n - '.join(a))
+    if a and b:
+        message += "Также "
+    if b:
+        message += "отменены:\n - {}\n\n".format('\n - '.join(b))
+
+    doctor_message = message + 'Изменить назначения можно в настройках интеллектуального агента "Мониторинг медицинских измерений и приема препаратов". <a href="https://drive.google.com/file/d/1PM4qWP2Cfm1p5W2fqbFC8iZahe5nhtjB/view?usp=sharing">Подробная схема мониторинга.</a>'
+    patient_message = message + 'Если у вас возникнут вопросы, их можно задать вашему лечащему врачу в чате.'
+
+    return doctor_message, patient_message
+
+
+def enqueue_orders_warning(contract_id, a, b):
+    doctor_message, patient_message = orders_warning_messages(a, b)
+
+    enqueue_message(contract_id, text=doctor_message, only_doctor=True)
+    enqueue_message(contract_id, text=patient_message, only_patient=True)
+
+
+def merge_changes(added, removed, changes):
+    # an order started after being stopped within the window (or the other way round) is no news
+    for comment in changes:
+        if comment in removed:
+            removed.remove(comment)
         else:
-            agents_api.send_message(contract_id,
-                                    text="Спасибо за заполнение опросника! Скорее всего, перечисленные вами симптомы являются нормой для вашего срока беременности. Но если у вас остались вопросы, вы можете уточнить их у вашего лечащего врача в чате.", only_patient=True)
-    except Exception as e:
-        print('connection error', e)
+            added.append(comment)
+
+
+def send_orders_warning(contract_id, a, b):
+    if not ORDER_DIGEST_WINDOW:
+        enqueue_orders_warning(contract_id, a, b)
+        return
+
+    # the window starts with the first change, so a busy contract still gets its digest on time;
+    # the no-op update locks an existing row, so flush_order_digests cannot delete it before the merge below
+    db.session.execute(text("INSERT INTO order_digest (contract_id, started, stopped, send_after) "
+                            "VALUES (:contract_id, '[]', '[]', :send_after) "
+                            "ON CONFLICT (contract_id) DO UPDATE SET send_after = order_digest.send_after"),
+                       {"contract_id": contract_id, "send_after": int(time.time()) + ORDER_DIGEST_WINDOW})
+    digest = OrderDigest.query.filter_by(contract_id=contract_id).with_for_update().one()
+
+    started, stopped = list(digest.started or []), list(digest.stopped or [])
+    merge_changes(started, stopped, a)
+    merge_changes(stopped, started, b)
+    digest.started, digest.stopped = started, stopped
+
+
+def flush_order_digests(batch_size=OUTBOX_BATCH_SIZE):
+    while True:
+        digests = OrderDigest.query.filter(OrderDigest.send_after <= int(time.time())) \
+            .order_by(OrderDigest.send_after).with_for_update(skip_locked=True).limit(batch_size).all()
+
+        if not digests:
+            db.session.commit()
+            return
+
+        for digest in digests:
+            if digest.started or digest.stopped:
+                enqueue_orders_warning(digest.contract_id, digest.started, digest.stopped)
+            db.session.delete(digest)
+
+        db.session.commit()
 
-def tasks():
-    contracts = Contract.query.filter_by(active=True).all()
+
+def send_warning(contract_id, a):
+    if a:
+        enqueue_message(contract_id,
+                        text="Беременная сообщила о следующих симптомах - {}.".format(' / '.join(a)),
+                        is_urgent=True, only_doctor=True, need_answer=True)
+        enqueue_message(contract_id,
+                        text="Спасибо за заполнение опросника! Мы уведомили вашего врача о симптомах, которые вызывают беспокойство на вашем сроке беременности ({}). Он свяжется с вами в ближайшее время.".format(' / '.join(a)),
+                        is_urgent=True, only_patient=True)
+    else:
+        enqueue_message(contract_id,
+                        text="Спасибо за заполнение опросника! Скорее всего, перечисленные вами симптомы являются нормой для вашего срока беременности. Но если у вас остались вопросы, вы можете уточнить их у вашего лечащего врача в чате.", only_patient=True)
+
+# windows are (start offset, end offset) in seconds before now
+MEASUREMENT_WINDOWS = {
+    'weight': {
+        'last_hour': (60 * 60, 0),
+        'previous_week': (60 * 60 * 24 * 11, 60 * 60 * 24 * 4),
+    },
+    'waist_circumference': {
+        'last_hour': (60 * 60, 0),
+        'previous_week': (60 * 60 * 24 * 11, 60 * 60 * 24 * 4),
+    },
+}
+MEASUREMENT_CATEGORIES = list(MEASUREMENT_WINDOWS)
+MEASUREMENT_HISTORY = 60 * 60 * 24 * 11
+
+measurement_stats = RollingStore(MEASUREMENT_WINDOWS)
+
+
+class MeasurementCache:
+    # watermarks for a batch of contracts; records live in measurement_record and measurement_stats
+    def __init__(self, contract_ids):
+        self.contract_ids = set(contract_ids)
+        self.syncs = {contract_id: {} for contract_id in contract_ids}
+        self.alerts = {}
+
+        if not contract_ids:
+            return
+
+        for sync in MeasurementSync.query.filter(MeasurementSync.contract_id.in_(contract_ids)).all():
+            self.syncs[sync.contract_id][sync.category] = sync
+
+        for state in AlertState.query.filter(AlertState.contract_id.in_(contract_ids)).all():
+            self.alerts[(state.contract_id, state.rule)] = state
+
+        # series this process has not seen yet are warmed from the local table once
+        cold = [contract_id for contract_id in contract_ids
+                if (contract_id, MEASUREMENT_CATEGORIES[0]) not in measurement_stats]
+        for contract_id in cold:
+            for category in MEASUREMENT_CATEGORIES:
+                measurement_stats.get(contract_id, category)
+
+        if cold:
+            records = MeasurementRecord.query.filter(MeasurementRecord.contract_id.in_(cold)) \
+                .order_by(MeasurementRecord.timestamp).all()
+            for record in records:
+                if record.category in MEASUREMENT_WINDOWS:
+                    measurement_stats.get(record.contract_id, record.category).add(record.timestamp, record.value)
+
+    def __contains__(self, contract_id):
+        return contract_id in self.contract_ids
+
+    def since(self, contract_id, now):
+        since = {}
+        for category in MEASUREMENT_CATEGORIES:
+            sync = self.syncs[contract_id].get(category)
+            synced_until = sync.synced_until if sync else 0
+            since[category] = max(synced_until - MEASUREMENT_SYNC_OVERLAP, now - MEASUREMENT_HISTORY)
+        return since
+
+    def store(self, contract_id, fetched):
+        for category, records in fetched.items():
+            series = measurement_stats.get(contract_id, category)
+            newest = 0
+
+            # records/get answers newest first; appending in time order keeps the windows from being rebuilt
+            for record in sorted(records, key=lambda record: int(record['timestamp'])):
+                timestamp, value = int(record['timestamp']), float(record['value'])
+                newest = max(newest, timestamp)
+                if series.add(timestamp, value):
+                    db.session.add(MeasurementRecord(contract_id=contract_id, category=category, timestamp=timestamp,
+                                                     value=value))
+
+            sync = self.syncs[contract_id].get(category)
+            if not sync:
+                sync = MeasurementSync(contract_id=contract_id, category=category, synced_until=0)
+                db.session.add(sync)
+                self.syncs[contract_id][category] = sync
+            sync.synced_until = max(sync.synced_until or 0, newest)
+
+    def evaluate(self, contract_id, now):
+        # (rule, triggered, triggering record timestamp, text) for every rule there is data for
+        weight = measurement_stats.get(contract_id, 'weight')
+        waist = measurement_stats.get(contract_id, 'waist_circumference')
+        weight.advance(now)
+        waist.advance(now)
+
+        results = []
+
+        # control weight
+        last_value = weight['last_hour'].last
+        week_value = weight['previous_week'].mean
+        if last_value is not None and week_value is not None:
+            delta = last_value - week_value
+            results.append(('weight_gain', delta >= 1, weight['last_hour'].last_timestamp,
+                            "Предупреждение: последнее значение веса ({} кг) беременной превышает среднее за прошлую неделю ({} кг) на {} кг.".format(
+                                last_value, round(week_value, 1), round(delta, 1))))
+
+        last_value = waist['last_hour'].last
+        week_value = waist['previous_week'].mean
+        if last_value is not None and week_value is not None:
+            delta = last_value - week_value
+            results.append(('waist_growth', delta <= 1, waist['last_hour'].last_timestamp,
+                            "Предупреждение: последнее обхвата талии ({} см) беременной по сравнению со средним за прошлую неделю ({} см) изменилось всего на {} см.".format(
+                                last_value, round(week_value, 1), round(delta, 1))))
+
+        return results
+
+    def warnings(self, contract_id, now):
+        warnings = []
+
+        for rule, triggered, record_timestamp, text in self.evaluate(contract_id, now):
+            state = self.alerts.get((contract_id, rule))
+
+            if not triggered:
+                # a normal measurement re-arms the rule
+                if state and state.active:
+                    state.active = False
+                    state.cleared_at = now
+                continue
+
+            # the same record never alerts twice, a new one only after the suppression window
+            if state and state.active and (state.record_timestamp == record_timestamp or now < state.suppressed_until):
+                continue
+
+            if not state:
+                state = AlertState(contract_id=contract_id, rule=rule)
+                db.session.add(state)
+                self.alerts[(contract_id, rule)] = state
+
+            state.active = True
+            state.record_timestamp = record_timestamp
+            state.fired_at = now
+            state.suppressed_until = now + ALERT_SUPPRESSION
+            state.cleared_at = None
+            warnings.append(text)
+
+        return warnings
+
+
+def prune_measurements():
+    now = int(time.time())
+    MeasurementRecord.query.filter(MeasurementRecord.timestamp < now - MEASUREMENT_HISTORY) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+    # contracts that were not evaluated for a day are warmed again from the table when they come back
+    measurement_stats.expire(now - 60 * 60 * 24)
+
+
+def needs_measurements(week, is_born):
+    return week is not None and week >= 14 and not is_born
+
+
+def fetch_measurements(contract_id, since):
+    with tracing.span('get_records'):
+        return {category: agents_api.get_records(contract_id, category, time_from=time_from).get('values', [])
+                for category, time_from in since.items()}
+
+
+async def fetch_measurements_async(contract_id, since):
+    with tracing.span('get_records'):
+        answers = await asyncio.gather(*[agents_api_async.get_records(contract_id, category, time_from=time_from)
+                                         for category, time_from in since.items()])
+    return {category: answer.get('values', []) for category, answer in zip(since.keys(), answers)}
+
+
+def execute_orders(contract_id, to_stop, to_start):
+    stopped = [order for order in to_stop if order.stop(contract_id)]
+    started = [order for order in to_start if order.run(contract_id)]
+
+    return stopped, started
+
+
+def process_contract(contract_id, to_stop, to_start, since):
+    # runs in a worker thread, so it must not touch the ORM
+    with metrics.Timer('contract_seconds'), tracing.contract(contract_id):
+        stopped, started = [], []
+        if to_stop or to_start:
+            stopped, started = execute_orders(contract_id, to_stop, to_start)
+
+        fetched = fetch_measurements(contract_id, since) if since else {}
+        return stopped, started, fetched
+
+
+async def process_contract_async(contract_id, to_stop, to_start, since):
+    with metrics.Timer('contract_seconds'), tracing.contract(contract_id):
+        stopped = [order for order in to_stop if await order.stop_async(contract_id)]
+        started = [order for order in to_start if await order.run_async(contract_id)]
+
+        fetched = await fetch_measurements_async(contract_id, since) if since else {}
+        return stopped, started, fetched
+
+
+class ContractJob:
+    def __init__(self, contract, to_stop=(), to_start=(), since=None, orders=False):
+        self.contract = contract
+        self.to_stop = to_stop
+        self.to_start = to_start
+        self.since = since
+        self.orders = orders
+
+
+RECONCILE_QUERY = """
+    WITH contract_week AS (
+        SELECT id, is_born, COALESCE(risk_mask, 0) AS risk_mask,
+               FLOOR((EXTRACT(EPOCH FROM now()) - start) / :week)::int AS week
+        FROM contract
+        WHERE active AND start IS NOT NULL {shard_clause} {contract_clause}
+    )
+    SELECT 'stop', contract_week.id, "order".id
+    FROM contract_week
+    JOIN current_order ON current_order.contract_id = contract_week.id
+    JOIN "order" ON "order".id = current_order.order_id
+    WHERE contract_week.week <> 0 AND (
+        "order".retired
+        OR (contract_week.is_born AND NOT "order".after_birth)
+        OR (COALESCE("order".end_week, 0) <> 0 AND contract_week.week > "order".end_week)
+        OR contract_week.week < COALESCE("order".start_week, 0)
+        OR (COALESCE("order".risk_mask, 0) <> 0 AND contract_week.risk_mask & "order".risk_mask = 0))
+    UNION ALL
+    SELECT 'start', contract_week.id, "order".id
+    FROM contract_week
+    JOIN "order" ON CASE WHEN contract_week.is_born THEN "order".after_birth
+                         ELSE contract_week.week BETWEEN COALESCE("order".start_week, 0)
+                                                     AND COALESCE("order".end_week, contract_week.week) END
+    WHERE contract_week.week <> 0 AND NOT "order".retired
+      AND (COALESCE("order".risk_mask, 0) = 0 OR contract_week.risk_mask & "order".risk_mask <> 0)
+      AND NOT EXISTS (SELECT 1 FROM current_order
+                      WHERE current_order.contract_id = contract_week.id AND current_order.order_id = "order".id)
+"""
+
+
+def reconcile_plans(catalog, contract_ids=None):
+    # the same decision as Contract.plan_orders, computed for every active contract of the shard
+    # (or the given contracts) in one query
+    plans = {}
+    shard_clause = 'AND id % :shards = ANY(:held_shards)' if shard_connections is not None else ''
+    contract_clause = 'AND id = ANY(:contract_ids)' if contract_ids is not None else ''
+    rows = db.session.execute(text(RECONCILE_QUERY.format(shard_clause=shard_clause, contract_clause=contract_clause)),
+                              {"week": WEEK, "shards": JOBS_SHARDS, "held_shards": held_shards() or [],
+                               "contract_ids": list(contract_ids or [])}).fetchall()
+
+    for action, contract_id, order_id in rows:
+        entry = catalog.orders.get(order_id) or CatalogOrder(Order.query.get(order_id))
+        to_stop, to_start = plans.setdefault(contract_id, ([], []))
+        (to_stop if action == 'stop' else to_start).append(entry)
+
+    return plans
+
+
+def tick_scope(catalog, orders, measurements, contract_ids):
+    plans = None
+    if orders and RECONCILE_MODE == 'sql':
+        plans = reconcile_plans(catalog, contract_ids)
+        # requested contracts are all loaded, the ones without a diff still need their next wakeup
+        if not measurements and contract_ids is None:
+            contract_ids = list(plans)
+
+    return plans, contract_ids
+
+
+def plan_batch(contracts, catalog, now, orders=True, measurements=True, plans=None, counters=None):
+    if counters is None:
+        counters = {"evaluated": 0, "skipped": 0}
+    cache = MeasurementCache([contract.id for contract in contracts
+                              if measurements and needs_measurements(contract.week(), contract.is_born)])
+    jobs = []
 
     for contract in contracts:
-        if contract.start:
+        try:
+            with tracing.contract(contract.id), tracing.span('db'):
+                job = plan_contract(contract, catalog, now, orders, plans, cache, counters)
+            if job.orders or job.since:
+                jobs.append(job)
+        except Exception as e:
+            print("plan error", contract.id, e)
+
+    return cache, jobs
+
+
+def plan_contract(contract, catalog, now, orders, plans, cache, counters):
+    job = ContractJob(contract)
+    if orders and plans is not None:
+        if contract.id in plans:
+            job.orders = True
+            job.to_stop, job.to_start = plans[contract.id]
+            counters['evaluated'] += 1
+        elif contract.orders_due(now):
+            # the reconcile query evaluated it and found nothing to change
+            contract.mark_evaluated(catalog)
+            counters['evaluated'] += 1
+    elif orders and contract.orders_due(now):
+        if contract.fingerprint == contract.evaluation_fingerprint(catalog):
+            contract.next_check = contract.next_wakeup(catalog)
+            counters['skipped'] += 1
+        else:
+            job.orders = True
+            job.to_stop, job.to_start = contract.plan_orders(catalog)
+            counters['evaluated'] += 1
+    if contract.id in cache:
+        job.since = cache.since(contract.id, now)
+    return job
+
+
+def report_tick(counters, started):
+    counters['duration'] = round(time.time() - started, 3)
+    metrics.observe('tick_seconds', counters['duration'], {"driver": TASKS_DRIVER})
+    metrics.increment('tick_contracts_total', {"result": "evaluated"}, counters['evaluated'])
+    metrics.increment('tick_contracts_total', {"result": "skipped"}, counters['skipped'])
+    if counters.get('interrupted'):
+        metrics.increment('tick_interrupted_total')
+    print("{}: Tick done in {}s: {} contracts evaluated, {} skipped as unchanged".format(
+        gts(), counters['duration'], counters['evaluated'], counters['skipped']))
+
+
+def apply_result(job, catalog, cache, now, result):
+    contract = job.contract
+    stopped, started, fetched = result
+
+    with tracing.contract(contract.id), tracing.span('db'):
+        if job.orders:
+            contract.apply_orders(stopped, started)
+            contract.mark_evaluated(catalog, len(stopped) == len(job.to_stop) and len(started) == len(job.to_start))
+
+        if contract.id in cache:
+            cache.store(contract.id, fetched)
+            for warning in cache.warnings(contract.id, now):
+                send_warning_to_doctor(contract.id, warning)
+
+
+def commit_batch(planned):
+    started = time.time()
+    db.session.commit()
+    tracing.share('commit', time.time() - started, [job.contract.id for job in planned])
+    db.session.expunge_all()
+
+
+SHARD_LOCK_KEY = 7031
+
+# None outside of the jobs process; there every shard a worker holds maps to the connection keeping its lock
+shard_connections = None
+shard_lock = threading.Lock()
+shards_checked = 0
+
+
+def try_lock_shard(shard):
+    import psycopg2
+
+    connection = psycopg2.connect(db_string)
+    connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', (SHARD_LOCK_KEY, shard))
+    if cursor.fetchone()[0]:
+        return connection
+
+    connection.close()
+    return None
+
+
+def claim_shards():
+    # takes every shard that is free, so all contracts are covered by however many workers are alive and the extra
+    # ones wait as standbys; the session-level advisory lock lives as long as its connection, so a dead worker frees
+    # its shards
+    global shards_checked
+
+    with shard_lock:
+        for shard, connection in list(shard_connections.items()):
             try:
-                contract.check_orders()
-                contract.check_measurements()
+                connection.cursor().execute('SELECT 1')
             except Exception as e:
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                print(exc_type, fname, exc_tb.tb_lineno)
-                print("loop error", e)
+                print("{}: Shard {} connection lost: {}".format(gts(), shard, e))
+                del shard_connections[shard]
+
+        if len(shard_connections) < JOBS_SHARDS and time.time() - shards_checked >= JOBS_CLAIM_RETRY:
+            shards_checked = time.time()
+            for shard in range(JOBS_SHARDS):
+                if shard in shard_connections:
+                    continue
+                connection = try_lock_shard(shard)
+                if connection:
+                    shard_connections[shard] = connection
+                    print("{}: Claimed shard {} of {}".format(gts(), shard, JOBS_SHARDS))
+
+        return sorted(shard_connections)
+
+
+def start_shards():
+    global shard_connections
+
+    shard_connections = {}
+    while not claim_shards():
+        print("{}: All {} shards are taken, waiting".format(gts(), JOBS_SHARDS))
+        time.sleep(JOBS_CLAIM_RETRY)
+
+
+def ensure_shard():
+    return shard_connections is None or bool(claim_shards())
+
+
+def held_shards():
+    return None if shard_connections is None else sorted(shard_connections)
+
+
+def in_shard(contract_id):
+    return shard_connections is None or contract_id % JOBS_SHARDS in shard_connections
+
+
+def shard_filter(query):
+    if shard_connections is None:
+        return query
+    return query.filter((Contract.id % JOBS_SHARDS).in_(held_shards()))
+
+
+def contract_batches(batch_size=TASKS_BATCH_SIZE, contract_ids=None, after_id=0, until_id=None):
+    # keyset pagination with current orders preloaded, so a batch costs two queries
+    last_id = after_id
+
+    while True:
+        query = shard_filter(Contract.query.filter(Contract.active == True, Contract.start != None,
+                                                   Contract.id > last_id))
+        if until_id is not None:
+            query = query.filter(Contract.id <= until_id)
+        if contract_ids is not None:
+            query = query.filter(Contract.id.in_(contract_ids))
+        batch = query.order_by(Contract.id).options(selectinload(Contract.current_orders)).limit(batch_size).all()
+
+        if not batch:
+            return
+
+        last_id = batch[-1].id
+        yield batch
+
+
+resume_cursors = {}
+
+
+def tick_batches(kind, contract_ids):
+    # a tick cut short by the budget resumes after its last finished contract and wraps around to the beginning;
+    # explicit contract ids come from the order scheduler, which re-queues whatever is still due
+    cursor = resume_cursors.pop(kind, 0) if contract_ids is None else 0
+
+    for batch in contract_batches(contract_ids=contract_ids, after_id=cursor):
+        yield batch
+    if cursor:
+        for batch in contract_batches(contract_ids=contract_ids, until_id=cursor):
+            yield batch
+
+
+def out_of_budget(started):
+    return TASKS_TICK_BUDGET and time.time() - started >= TASKS_TICK_BUDGET
+
+
+def interrupt_tick(kind, resume_after, contract_ids, counters, waiting):
+    if contract_ids is None:
+        resume_cursors[kind] = resume_after
+    counters['interrupted'] = True
+    counters['resume_after'] = resume_after
+    counters['evaluated'] -= len([job for job in waiting if job.orders])
+    print("{}: Tick budget of {}s spent, resuming after contract {} next time".format(gts(), TASKS_TICK_BUDGET,
+                                                                                      resume_after))
+
+
+def tasks(orders=True, measurements=True, contract_ids=None):
+    catalog = get_catalog()
+    if measurements:
+        prune_measurements()
+    started = time.time()
+    counters = {"evaluated": 0, "skipped": 0}
+    plans, contract_ids = tick_scope(catalog, orders, measurements, contract_ids)
+
+    kind = (orders, measurements)
+    with ThreadPoolExecutor(max_workers=TASKS_WORKERS) as executor:
+        for contracts in tick_batches(kind, contract_ids):
+            now = int(time.time())
+            cache, planned = plan_batch(contracts, catalog, now, orders, measurements, plans, counters)
+            submitted = 0
+            jobs = {}
+
+            # contracts are submitted in id order while the budget lasts, so the ones left over are the tail of the
+            # batch; ORM changes are applied in this thread only, once each contract's outbound calls are done
+            while submitted < len(planned) or jobs:
+                while submitted < len(planned) and len(jobs) < TASKS_WORKERS and not out_of_budget(started):
+                    job = planned[submitted]
+                    submitted += 1
+                    jobs[executor.submit(contextvars.copy_context().run, process_contract, job.contract.id,
+                                         job.to_stop, job.to_start, job.since)] = job
+                if not jobs:
+                    break
+
+                for future in wait(jobs, return_when=FIRST_COMPLETED).done:
+                    job = jobs.pop(future)
+                    try:
+                        apply_result(job, catalog, cache, now, future.result())
+                    except Exception as e:
+                        exc_type, exc_obj, exc_tb = sys.exc_info()
+                        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+                        print(exc_type, fname, exc_tb.tb_lineno)
+                        print("loop error", job.contract.id, e)
+
+            waiting = planned[submitted:]
+            resume_after = waiting[0].contract.id - 1 if waiting else contracts[-1].id
+            commit_batch(planned[:submitted])
+            if waiting or out_of_budget(started):
+                interrupt_tick(kind, resume_after, contract_ids, counters, waiting)
+                break
+
+    report_tick(counters, started)
+    return counters
+
+
+async def tasks_async(orders=True, measurements=True, contract_ids=None):
+    # same tick as tasks(), but outbound calls are multiplexed on one event loop
+    catalog = get_catalog()
+    if measurements:
+        prune_measurements()
+    started = time.time()
+    counters = {"evaluated": 0, "skipped": 0}
+    plans, contract_ids = tick_scope(catalog, orders, measurements, contract_ids)
+    semaphore = asyncio.Semaphore(TASKS_ASYNC_CONCURRENCY)
+    kind = (orders, measurements)
+
+    async with agents_api_async.session_scope():
+        for contracts in tick_batches(kind, contract_ids):
+            now = int(time.time())
+            cache, planned = plan_batch(contracts, catalog, now, orders, measurements, plans, counters)
+            running = []
+
+            # a slot is taken before the budget is checked, so nothing starts after it has run out
+            for job in planned:
+                await semaphore.acquire()
+                if out_of_budget(started):
+                    semaphore.release()
+                    break
+                task = asyncio.ensure_future(process_contract_async(job.contract.id, job.to_stop, job.to_start,
+                                                                    job.since))
+                task.add_done_callback(lambda task: semaphore.release())
+                running.append(task)
+
+            results = await asyncio.gather(*running, return_exceptions=True)
+            for job, result in zip(planned, results):
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+                    apply_result(job, catalog, cache, now, result)
+                except Exception as e:
+                    print("loop error", job.contract.id, e)
+
+            waiting = planned[len(running):]
+            resume_after = waiting[0].contract.id - 1 if waiting else contracts[-1].id
+            commit_batch(planned[:len(running)])
+            if waiting or out_of_budget(started):
+                interrupt_tick(kind, resume_after, contract_ids, counters, waiting)
+                break
+
+    report_tick(counters, started)
+    return counters
+
+
+def run_tasks(**params):
+    if not ensure_shard():
+        print("{}: No shard held, skipping tick".format(gts()))
+        return
+
+    with tracing.tick('tasks' if params.get('orders', True) else 'measurements'):
+        if TASKS_DRIVER == 'async':
+            return asyncio.run(tasks_async(**params))
+        else:
+            return tasks(**params)
+
+
+def notify_wakeup(contract_id, next_check):
+    # delivered to the order scheduler when the surrounding transaction commits
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_notify('contract_wakeup', :payload)"),
+                           {"payload": "{}:{}".format(contract_id, next_check or '')})
+
+
+def wakeup_listener():
+    import psycopg2
+
+    connection = psycopg2.connect(db_string)
+    connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    connection.cursor().execute('LISTEN contract_wakeup')
+    return connection
+
+
+def wait_wakeups(connection, timeout):
+    if select.select([connection], [], [], timeout) == ([], [], []):
+        return []
+
+    connection.poll()
+    wakeups = []
+    while connection.notifies:
+        contract_id, next_check = connection.notifies.pop(0).payload.split(':')
+        wakeups.append((int(contract_id), int(next_check) if next_check else None))
+    return wakeups
+
+
+def scheduled_time(next_check, now):
+    if next_check is None:
+        return now
+    return None if next_check == NO_WAKEUP else next_check
+
+
+def retry_time(next_check, now, left_over=False):
+    # a contract that is still due after its tick failed somewhere along the way and waits before the next attempt,
+    # unless the tick budget ran out before it was reached
+    if next_check == NO_WAKEUP:
+        return None
+    if next_check is None or next_check <= now:
+        return now if left_over else max(next_check or 0, now + ORDER_RETRY_DELAY)
+    return next_check
+
+
+def order_scheduler():
+    # sleeps until the earliest week boundary that matters to some contract instead of rescanning everyone
+    queue = WakeQueue()
+    listener = wakeup_listener()
+    resync_at = 0
+    seeded_shards = None
+
+    while True:
+        if not ensure_shard():
+            time.sleep(JOBS_CLAIM_RETRY)
+            continue
+
+        now = int(time.time())
+        shards = held_shards()
+
+        if now >= resync_at or shards != seeded_shards:
+            # a full pass seeds the queue, also when shards were taken over; later ones only pick up contracts
+            # reset outside of notifications
+            query = shard_filter(db.session.query(Contract.id, Contract.next_check).filter(Contract.active == True,
+                                                                                           Contract.start != None))
+            if resync_at and shards == seeded_shards:
+                query = query.filter(or_(Contract.next_check == None, Contract.next_check <= now))
+            seeded_shards = shards
+            for contract_id, next_check in query.all():
+                queue.push(contract_id, scheduled_time(next_check, now))
+            db.session.commit()
+            resync_at = now + ORDER_SCHEDULER_RESYNC
+
+        due = queue.pop_due(now, limit=TASKS_BATCH_SIZE)
+        if due:
+            counters = run_tasks(measurements=False, contract_ids=due)
+            resume_after = counters.get('resume_after') if counters else None
+            for contract_id, next_check in db.session.query(Contract.id, Contract.next_check) \
+                    .filter(Contract.id.in_(due), Contract.active == True).all():
+                left_over = resume_after is not None and contract_id > resume_after
+                queue.push(contract_id, retry_time(next_check, now, left_over))
+            db.session.commit()
+            continue
+
+        next_time = queue.next_time()
+        timeout = min(next_time, resync_at) - now if next_time else resync_at - now
+        for contract_id, next_check in wait_wakeups(listener, max(timeout, 0)):
+            if in_shard(contract_id):
+                queue.push(contract_id, scheduled_time(next_check, now) if next_check else None)
 
-    db.session.commit()
 
 def sender():
+    start_shards()
     while True:
-        tasks()
+        run_tasks()
         time.sleep(60 * 5)
 
 
@@ -517,8 +1557,72 @@ def check_params(contract, data):
         warnings.append('кровянистые выделения из половых путей')
 
 
+    # the upload happens in the background; the sweep in the jobs process picks the report up if it is lost here
+    symptom_report = SymptomReport(contract_id=contract.id, values=report,
+                                   next_attempt=int(time.time()) + SYMPTOM_REPORT_GRACE)
+    db.session.add(symptom_report)
     send_warning(contract.id, warnings)
-    agents_api.add_records(contract.id, report)
+    db.session.commit()
+
+    return symptom_report
+
+
+report_executor = ThreadPoolExecutor(max_workers=SYMPTOM_WORKERS)
+
+
+def upload_report(job):
+    contract_id, values = job
+    try:
+        agents_api.upload_records(contract_id, values)
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+
+
+def apply_report_result(report, error, now):
+    if not error:
+        report.status = 'done'
+        report.processed_on = datetime.datetime.now()
+        report.next_attempt = None
+    elif not retry_later(report, error, now):
+        report.status = 'failed'
+        report.processed_on = datetime.datetime.now()
+        print("{}: Symptom report {} failed after {} attempts: {}".format(gts(), report.id, report.attempts, error))
+
+
+def process_report(report_id):
+    # runs in report_executor right after the form is acknowledged
+    with app.app_context():
+        try:
+            report = SymptomReport.query.filter(SymptomReport.id == report_id, SymptomReport.status == 'pending') \
+                .with_for_update(skip_locked=True).first()
+            if report:
+                apply_report_result(report, upload_report((report.contract_id, report.values)), int(time.time()))
+                db.session.commit()
+                dispatch_outbox(contract_id=report.contract_id)
+        except Exception as e:
+            print("{}: Symptom report {} error: {}".format(gts(), report_id, e))
+        finally:
+            db.session.remove()
+
+
+def dispatch_reports(batch_size=OUTBOX_BATCH_SIZE):
+    # retries failed uploads and picks up reports whose web worker died before processing them
+    while True:
+        now = int(time.time())
+        reports = SymptomReport.query.filter(SymptomReport.status == 'pending', SymptomReport.next_attempt <= now) \
+            .order_by(SymptomReport.id).with_for_update(skip_locked=True).limit(batch_size).all()
+
+        if not reports:
+            db.session.commit()
+            return
+
+        with ThreadPoolExecutor(max_workers=OUTBOX_WORKERS) as executor:
+            errors = list(executor.map(upload_report, [(report.contract_id, report.values) for report in reports]))
+
+        for report, error in zip(reports, errors):
+            apply_report_result(report, error, now)
+
+        db.session.commit()
 
 
 @app.route('/frame', methods=['POST'])
@@ -537,16 +1641,51 @@ def action_save():
 
     contract = query.first()
 
-    check_params(contract, request.form)
+    symptom_report = check_params(contract, request.form)
+    report_executor.submit(process_report, symptom_report.id)
 
-    print("{}: Form from {}".format(gts(), contract_id))
+    print("{}: Form from {} saved as report {}".format(gts(), contract_id, symptom_report.id))
 
     return """
             <strong>Спасибо, окно можно закрыть</strong><script>window.parent.postMessage('close-modal-success','*');</script>
             """
 
+
+@app.route('/frame/status', methods=['GET'])
+def report_status():
+    key = request.args.get('api_key', '')
+    if key != APP_KEY:
+        return "<strong>Некорректный ключ доступа.</strong> Свяжитесь с технической поддержкой."
+
+    try:
+        contract_id = int(request.args.get('contract_id', -1))
+        query = SymptomReport.query.filter_by(contract_id=contract_id)
+        if request.args.get('report_id'):
+            query = query.filter_by(id=int(request.args.get('report_id')))
+        reports = query.order_by(SymptomReport.id.desc()).limit(10).all()
+    except:
+        return "error"
+
+    return json.dumps([{
+        "id": report.id,
+        "status": report.status,
+        "attempts": report.attempts,
+        "last_error": report.last_error,
+        "created_on": report.created_on.isoformat() if report.created_on else None,
+        "processed_on": report.processed_on.isoformat() if report.processed_on else None,
+    } for report in reports])
+
+try:
+    # every process builds the catalog while starting, not on its first request or tick
+    with app.app_context():
+        get_catalog()
+except Exception as e:
+    print('cant load catalog', e)
+
 if __name__ == "__main__":
     t = Thread(target=sender)
     t.start()
 
+    Thread(target=outbox_sender).start()
+
     app.run(port=PORT, host=HOST)
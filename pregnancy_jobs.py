@@ -1,7 +1,21 @@
 from pregnancy_bot import *
-from apscheduler.schedulers.background import BlockingScheduler
+from apscheduler.schedulers.background import BackgroundScheduler, BlockingScheduler
 
+start_shards()
 
-scheduler = BlockingScheduler()
-scheduler.add_job(tasks, 'interval', minutes=5)
-scheduler.start()
\ No newline at end of file
+if ORDER_SCHEDULER:
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(run_tasks, 'interval', minutes=5, kwargs={"orders": False})
+    scheduler.add_job(flush_order_digests, 'interval', seconds=OUTBOX_INTERVAL)
+    scheduler.add_job(dispatch_outbox, 'interval', seconds=OUTBOX_INTERVAL)
+    scheduler.add_job(dispatch_reports, 'interval', seconds=OUTBOX_INTERVAL)
+    scheduler.start()
+
+    order_scheduler()
+else:
+    scheduler = BlockingScheduler()
+    scheduler.add_job(run_tasks, 'interval', minutes=5)
+    scheduler.add_job(flush_order_digests, 'interval', seconds=OUTBOX_INTERVAL)
+    scheduler.add_job(dispatch_outbox, 'interval', seconds=OUTBOX_INTERVAL)
+    scheduler.add_job(dispatch_reports, 'interval', seconds=OUTBOX_INTERVAL)
+    scheduler.start()
@@ -0,0 +1,150 @@
+from collections import deque
+from bisect import insort
+
+
+class RollingWindow:
+    """
+    Points with now - start_offset <= timestamp <= now - end_offset.
+
+    count, mean, min and max are maintained incrementally: every point enters and leaves the window once,
+    min/max use monotonic deques. Points are expected in timestamp order; an older point forces a rebuild.
+    """
+
+    def __init__(self, start_offset, end_offset=0):
+        self.start_offset = start_offset
+        self.end_offset = end_offset
+        self.pending = deque()
+        self.active = deque()
+        self.minimums = deque()
+        self.maximums = deque()
+        self.total = 0
+        self.sequence = 0
+
+    def add(self, timestamp, value):
+        newest = self.pending[-1] if self.pending else (self.active[-1] if self.active else None)
+        if newest and timestamp < newest[0]:
+            self.rebuild(sorted(list(self.active) + list(self.pending) + [(timestamp, value, 0)]))
+            return
+
+        self.sequence += 1
+        self.pending.append((timestamp, value, self.sequence))
+
+    def rebuild(self, points):
+        self.pending.clear()
+        self.active.clear()
+        self.minimums.clear()
+        self.maximums.clear()
+        self.total = 0
+
+        for timestamp, value, _ in points:
+            self.sequence += 1
+            self.pending.append((timestamp, value, self.sequence))
+
+    def advance(self, now):
+        while self.pending and self.pending[0][0] <= now - self.end_offset:
+            point = self.pending.popleft()
+            self.active.append(point)
+            self.total += point[1]
+
+            while self.minimums and self.minimums[-1][1] >= point[1]:
+                self.minimums.pop()
+            self.minimums.append(point)
+
+            while self.maximums and self.maximums[-1][1] <= point[1]:
+                self.maximums.pop()
+            self.maximums.append(point)
+
+        while self.active and self.active[0][0] < now - self.start_offset:
+            point = self.active.popleft()
+            self.total -= point[1]
+
+            if self.minimums and self.minimums[0][2] == point[2]:
+                self.minimums.popleft()
+            if self.maximums and self.maximums[0][2] == point[2]:
+                self.maximums.popleft()
+
+    @property
+    def count(self):
+        return len(self.active)
+
+    @property
+    def mean(self):
+        return self.total / len(self.active) if self.active else None
+
+    @property
+    def min(self):
+        return self.minimums[0][1] if self.minimums else None
+
+    @property
+    def max(self):
+        return self.maximums[0][1] if self.maximums else None
+
+    @property
+    def last(self):
+        return self.active[-1][1] if self.active else None
+
+    @property
+    def last_timestamp(self):
+        return self.active[-1][0] if self.active else None
+
+
+class RollingSeries:
+    """All windows of one category for one contract, fed with deduplicated records."""
+
+    def __init__(self, windows):
+        self.windows = {name: RollingWindow(*offsets) for name, offsets in windows.items()}
+        self.horizon = max(start_offset for start_offset, end_offset in windows.values())
+        self.history = deque()
+        self.seen = set()
+        self.touched = None
+
+    def add(self, timestamp, value):
+        if (timestamp, value) in self.seen:
+            return False
+
+        self.seen.add((timestamp, value))
+        if self.history and timestamp < self.history[-1][0]:
+            insort(self.history, (timestamp, value))
+        else:
+            self.history.append((timestamp, value))
+        for window in self.windows.values():
+            window.add(timestamp, value)
+        return True
+
+    def advance(self, now):
+        self.touched = now
+
+        for window in self.windows.values():
+            window.advance(now)
+
+        while self.history and self.history[0][0] < now - self.horizon:
+            self.seen.discard(self.history.popleft())
+
+    def __getitem__(self, name):
+        return self.windows[name]
+
+
+class RollingStore:
+    """
+    Process-wide RollingSeries keyed by (contract_id, category).
+
+    windows maps a category to {window name: (start_offset, end_offset)}. Not thread-safe: feed and query it
+    from one thread.
+    """
+
+    def __init__(self, windows):
+        self.windows = windows
+        self.series = {}
+
+    def __contains__(self, key):
+        return key in self.series
+
+    def get(self, contract_id, category):
+        key = (contract_id, category)
+        if key not in self.series:
+            self.series[key] = RollingSeries(self.windows[category])
+        return self.series[key]
+
+    def expire(self, older_than):
+        for key in [key for key, series in self.series.items() if series.touched and series.touched < older_than]:
+            del self.series[key]
@@ -1,6 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
 from config import *
 from flask import Flask
+from sqlalchemy import text
+import json
 
 app = Flask(__name__)
 db_string = "postgresql://{}:{}@{}:{}/{}".format(DB_LOGIN, DB_PASSWORD, DB_HOST, DB_PORT, DB_DATABASE)
@@ -10,6 +12,8 @@ db = SQLAlchemy(app)
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(255), nullable=True, unique=True, index=True)
+    retired = db.Column(db.Boolean, default=False)
     start_order = db.Column(db.String(255))
     start_params = db.Column(db.JSON, nullable=True)
     end_order = db.Column(db.String(255))
@@ -18,22 +22,25 @@ class Order(db.Model):
     end_week = db.Column(db.Integer, nullable=True)
     after_birth = db.Column(db.Boolean, default=True)
     risks = db.relationship('Risk', secondary='order_risk')
+    risk_mask = db.Column(db.BigInteger, default=0)
     comment = db.Column(db.Text, nullable=True)
 
 class Risk(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(512))
     comment = db.Column(db.String(512))
-    code = db.Column(db.String(512), nullable=True)
+    code = db.Column(db.String(512), nullable=True, index=True)
+    bit = db.Column(db.Integer, nullable=True, unique=True)
 
 
 class OrderRisk(db.Model):
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), primary_key=True)
     risk_id = db.Column(db.Integer, db.ForeignKey('risk.id'), primary_key=True)
 
-OrderRisk.query.delete()
-Order.query.delete()
-Risk.query.delete()
+
+class CatalogVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0)
 
 
 default_risks = [
@@ -84,12 +91,6 @@ default_risks = [
     },
 ]
 
-for risk in default_risks:
-    object = Risk(name=risk['name'], comment=risk['comment'], code=risk['code'])
-    db.session.add(object)
-
-db.session.commit()
-
 timetable = {
     "days_month": [],
     "days_week": [],
@@ -98,6 +99,7 @@ timetable = {
 
 default_orders = [
     {
+        "code": "temperature_monitoring",
         "start_order": "enable_monitoring",
         "start_params": {
             "category": "temperature",
@@ -117,6 +119,7 @@ default_orders = [
         "comment": "мониторинг температуры",
     },
     {
+        "code": "pressure_monitoring",
         "start_order": "enable_monitoring",
         "start_params": {
             "category": "pressure",
@@ -144,6 +147,7 @@ default_orders = [
         "comment": "мониторинг пульса и давления",
     },
     {
+        "code": "weight_monitoring",
         "start_order": "enable_monitoring",
         "start_params": {
             "category": "weight",
@@ -163,6 +167,7 @@ default_orders = [
         "comment": "мониторинг веса",
     },
     {
+        "code": "waist_monitoring",
         "start_order": "enable_monitoring",
         "start_params": {
             "category": "waist_circumference",
@@ -197,6 +202,7 @@ default_orders = [
     # amount = data['params']['amount']
     # timetable = json.dumps(data['params']['timetable'])
     {
+        "code": "folic_acid",
         "start_order": "add_medicine",
         "start_params": {
             "name": "Фолиевая кислота",
@@ -216,6 +222,7 @@ default_orders = [
         "comment": "назначение филиевой кислоты"
     },
     {
+        "code": "potassium_iodide",
         "start_order": "add_medicine",
         "start_params": {
             "name": "Калия йодид",
@@ -235,6 +242,7 @@ default_orders = [
         "comment": "назначение йодида калия"
     },
     {
+        "code": "vitamin_d_risk_gv",
         "start_order": "add_medicine",
         "start_params": {
             "name": "Витамин D",
@@ -254,6 +262,7 @@ default_orders = [
         "comment": "назначение витамина D"
     },
     {
+        "code": "calcium_risk_pe",
         "start_order": "add_medicine",
         "start_params": {
             "name": "Кальций",
@@ -273,6 +282,7 @@ default_orders = [
         "comment": "назначение кальция"
     },
     {
+        "code": "aspirin_risk_pe",
         "start_order": "add_medicine",
         "start_params": {
             "name": "Ацетилсаллициловая кислота",
@@ -292,6 +302,7 @@ default_orders = [
         "comment": "назначение ацетилсаллиициловой кислоты"
     },
     {
+        "code": "progesterone_risk_vrt",
         "start_order": "add_medicine",
         "start_params": {
             "name": "Прогестерон натуральный",
@@ -311,6 +322,7 @@ default_orders = [
         "comment": "назначение прогестерона"
     },
     {
+        "code": "progesterone_risk_sa",
         "start_order": "add_medicine",
         "start_params": {
             "name": "Прогестерон натуральный",
@@ -330,6 +342,7 @@ default_orders = [
         "comment": "назначение прогестерона"
     },
     {
+        "code": "progesterone_risk_pr",
         "start_order": "add_medicine",
         "start_params": {
             "name": "Прогестерон натуральный",
@@ -349,6 +362,7 @@ default_orders = [
         "comment": "назначение прогестерона"
     },
     {
+        "code": "vitamin_b6_voming",
         "start_order": "add_medicine",
         "start_params": {
             "name": "Витамин В6, пиридоксин",
@@ -369,13 +383,104 @@ default_orders = [
     },
 ]
 
-for order in default_orders:
-    object = Order(start_order=order['start_order'], start_params=order['start_params'], end_order=order['end_order'], end_params=order['end_params'],
-                   start_week=order['start_week'], end_week=order['end_week'], after_birth=order['after_birth'], comment=order['comment'])
 
-    db.session.add(object)
+# The catalog is declarative: rows are matched by code, unchanged rows are left alone, so order ids (and the
+# current_order rows of live contracts) survive a deploy. Orders dropped from the list are retired, not deleted,
+# and the bot stops them for contracts that still run them.
+ORDER_FIELDS = ['start_order', 'start_params', 'end_order', 'end_params', 'start_week', 'end_week', 'after_birth',
+                'comment']
+
+
+def natural_key(order, risk_codes):
+    # identifies orders created before they had a code
+    return (order['start_order'], json.dumps(order['start_params'], sort_keys=True), order['start_week'],
+            order['end_week'], tuple(sorted(risk_codes)))
+
+
+def load_risks(declared):
+    risks = {risk.code: risk for risk in Risk.query.all()}
+    next_bit = max([risk.bit for risk in risks.values() if risk.bit is not None], default=-1) + 1
+    changes = 0
+
+    for description in declared:
+        risk = risks.get(description['code'])
+        if not risk:
+            risk = Risk(code=description['code'], bit=next_bit)
+            next_bit += 1
+            risks[risk.code] = risk
+            db.session.add(risk)
+
+        if (risk.name, risk.comment) != (description['name'], description['comment']):
+            risk.name, risk.comment = description['name'], description['comment']
+            changes += 1
+
+    return risks, changes
+
+
+def load_orders(declared, risks):
+    existing = Order.query.all()
+    by_code = {order.code: order for order in existing if order.code}
+    by_key = {natural_key({field: getattr(order, field) for field in ORDER_FIELDS},
+                          [risk.code for risk in order.risks]): order
+              for order in existing if not order.code}
+    changes = 0
+    seen = set()
+
+    for description in declared:
+        order = by_code.get(description['code']) or by_key.get(natural_key(description, description['risks']))
+        if not order:
+            order = Order(code=description['code'])
+            db.session.add(order)
+
+        updated = order.id is None or order.code != description['code'] or order.retired
+        order.code = description['code']
+        order.retired = False
+
+        for field in ORDER_FIELDS:
+            if getattr(order, field) != description[field]:
+                setattr(order, field, description[field])
+                updated = True
+
+        if sorted(risk.code for risk in order.risks) != sorted(description['risks']):
+            order.risks = [risks[code] for code in description['risks']]
+            updated = True
+
+        risk_mask = 0
+        for code in description['risks']:
+            risk_mask |= 1 << risks[code].bit
+        if order.risk_mask != risk_mask:
+            order.risk_mask = risk_mask
+            updated = True
+
+        seen.add(order.code)
+        changes += updated
+
+    for order in existing:
+        if order.code not in seen and not order.retired:
+            order.retired = True
+            changes += 1
+
+    return changes
+
+
+risks, risk_changes = load_risks(default_risks)
+db.session.flush()
+order_changes = load_orders(default_orders, risks)
+print('catalog: {} risks and {} orders changed'.format(risk_changes, order_changes))
+
+if risk_changes or order_changes:
+    catalog_version = CatalogVersion.query.get(1)
+    if not catalog_version:
+        catalog_version = CatalogVersion(id=1, version=0)
+        db.session.add(catalog_version)
+    catalog_version.version += 1
+
+    # running processes swap in the new catalog without a restart
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SELECT pg_notify('catalog_version', :version)"),
+                           {"version": str(catalog_version.version)})
 
-    for risk in order['risks']:
-        object.risks.append(Risk.query.filter_by(code=risk).first())
+    # every contract is re-evaluated against the new catalog
+    db.session.execute(text('UPDATE contract SET next_check = NULL'))
 
 db.session.commit()
@@ -0,0 +1,154 @@
+from config import *
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+import contextvars
+import threading
+import logging
+import json
+import time
+
+# Span timings per contract for a tick (or a single check_orders call). The slowest contracts are written as one
+# JSON line per tick to TRACE_FILE. With TRACE_ENABLED off every hook is a flag check.
+
+# context variables, so concurrent ticks of one process (and their asyncio tasks) do not mix;
+# work handed to a thread pool has to run in contextvars.copy_context()
+current_tick = contextvars.ContextVar('current_tick', default=None)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+logger = None
+logger_lock = threading.Lock()
+
+
+class ContractTrace:
+    def __init__(self, contract_id):
+        self.contract_id = contract_id
+        self.spans = {}
+        self.orders = []
+
+    def add(self, name, duration):
+        self.spans[name] = self.spans.get(name, 0) + duration
+
+    @property
+    def total(self):
+        return sum(self.spans.values())
+
+    def as_dict(self):
+        return {
+            "contract_id": self.contract_id,
+            "total": round(self.total, 4),
+            "spans": {name: round(duration, 4) for name, duration in self.spans.items()},
+            "orders": [[order_id, action, round(duration, 4)] for order_id, action, duration in self.orders],
+        }
+
+
+class Tick:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.contracts = {}
+        self.lock = threading.Lock()
+
+    def contract(self, contract_id):
+        with self.lock:
+            if contract_id not in self.contracts:
+                self.contracts[contract_id] = ContractTrace(contract_id)
+            return self.contracts[contract_id]
+
+    def record(self):
+        traces = list(self.contracts.values())
+        totals = {}
+        for trace in traces:
+            for name, duration in trace.spans.items():
+                totals[name] = totals.get(name, 0) + duration
+
+        return {
+            "tick": self.name,
+            "started": int(self.started),
+            "duration": round(time.time() - self.started, 4),
+            "contracts": len(traces),
+            "totals": {name: round(duration, 4) for name, duration in totals.items()},
+            "slowest": [trace.as_dict() for trace in sorted(traces, key=lambda trace: trace.total,
+                                                            reverse=True)[:TRACE_SLOWEST]],
+        }
+
+
+def get_logger():
+    global logger
+
+    with logger_lock:
+        if logger is None:
+            logger = logging.getLogger('pregnancy.trace')
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            logger.addHandler(RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS))
+        return logger
+
+
+def write(record):
+    try:
+        get_logger().info(json.dumps(record, ensure_ascii=False))
+    except Exception as e:
+        print('trace write error', e)
+
+
+@contextmanager
+def tick(name):
+    if not TRACE_ENABLED:
+        yield None
+        return
+
+    started = Tick(name)
+    token = current_tick.set(started)
+    try:
+        yield started
+    finally:
+        current_tick.reset(token)
+        write(started.record())
+
+
+@contextmanager
+def contract(contract_id):
+    # outside of a tick the contract gets a trace of its own, written only when it was slow
+    if not TRACE_ENABLED:
+        yield None
+        return
+
+    parent = current_tick.get()
+    own = parent is None
+    if own:
+        parent = Tick('contract')
+    trace = parent.contract(contract_id)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+        if own and trace.total >= TRACE_MIN_SECONDS:
+            write(parent.record())
+
+
+@contextmanager
+def span(name, order_id=None, action=None):
+    trace = current_trace.get() if TRACE_ENABLED else None
+    if trace is None:
+        yield
+        return
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - started
+        trace.add(name, duration)
+        if order_id is not None:
+            trace.orders.append((order_id, action, duration))
+
+
+def share(name, duration, contract_ids):
+    # a batch-wide span (the commit) split evenly between the contracts it covered
+    parent = current_tick.get() if TRACE_ENABLED else None
+    if parent is None or not contract_ids:
+        return
+
+    for contract_id in contract_ids:
+        parent.contract(contract_id).add(name, duration / len(contract_ids))
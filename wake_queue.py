@@ -0,0 +1,53 @@
+import heapq
+
+
+class WakeQueue:
+    """
+    Min-heap of (wake-up time, contract id).
+
+    Rescheduling a contract pushes a new entry and leaves the old one in the heap; stale entries are skipped
+    when they reach the top.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.scheduled = {}
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def push(self, contract_id, when):
+        if when is None:
+            self.discard(contract_id)
+            return
+
+        if self.scheduled.get(contract_id) == when:
+            return
+
+        self.scheduled[contract_id] = when
+        heapq.heappush(self.heap, (when, contract_id))
+
+    def discard(self, contract_id):
+        self.scheduled.pop(contract_id, None)
+
+    def drop_stale(self):
+        while self.heap and self.scheduled.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def next_time(self):
+        self.drop_stale()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now, limit=None):
+        due = []
+
+        while self.heap and (limit is None or len(due) < limit):
+            self.drop_stale()
+            if not self.heap or self.heap[0][0] > now:
+                break
+
+            when, contract_id = heapq.heappop(self.heap)
+            del self.scheduled[contract_id]
+            due.append(contract_id)
+
+        return due